@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+
+"""
+Offline benchmark of the moderation hot path.
+Builds a synthetic chats/<id> tree (or uses an existing bot directory with --tree), replays generated
+or recorded updates through the real handlers of main.py against a fake Bot API and prints
+messages/sec, p50/p99 handler latency, API calls per update and the speed of the word checks.
+Nothing goes to the network; with the same arguments the corpus is the same on every run.
+Usage:
+python bench.py --chats 20 --words 300 --updates 2000
+python bench.py --corpus updates.jsonl --repeat 3
+python bench.py --long-share 0.05 --offload 2000 --workers 2
+python bench.py --chats 200 --startup
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler, filters
+from telegram.request import BaseRequest
+
+BENCH_TOKEN = "1:bench"
+BOT_ID = 1
+ADMIN_ID = 10
+# Слова-триггеры и обычная речь из разных слогов, иначе случайная болтовня сплошь похожа на мат
+TRIGGER_SYLLABLES = ["ка", "ра", "то", "ми", "не", "лу", "по", "ст", "ва", "ди", "ко", "ше", "бо", "зи", "пр", "ол"]
+CHATTER_SYLLABLES = ["га", "де", "жу", "ры", "фо", "цы", "чё", "ще", "ям", "юн", "эх", "ть", "ль", "гл", "дв", "сн",
+                     "ну", "ба", "ве", "ли", "мо", "ру", "са", "ту"]
+LOOKALIKES = {"а": "a", "о": "o", "е": "e", "с": "c", "р": "p", "к": "k", "х": "x"}
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def make_word(rnd, syllables=(2, 4), alphabet=TRIGGER_SYLLABLES):
+    return ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(*syllables)))
+
+
+def disguise(rnd, word):
+    """How people dodge the filter: latin lookalikes and doubled letters"""
+    letters = [LOOKALIKES.get(letter, letter) if rnd.random() < 0.4 else letter for letter in word]
+    position = rnd.randrange(len(letters))
+    letters[position] *= 2
+    return ''.join(letters)
+
+
+def build_tree(root, chats, words, helpers, seed):
+    """Writes config.json and chats/<id> for the given number of chats, returns {chat id: trigger lists}"""
+    rnd = random.Random(seed)
+    with open(os.path.join(root, 'config.json'), 'w', encoding='utf-8') as cf:
+        json.dump({"telegram_token": BENCH_TOKEN, "helper_keyword": "^бот", "random_fun_keyword": "пинг",
+                   "random_game_keyword": "^игра", "warn_keyword": "^Пред", "forward_pm": str(ADMIN_ID),
+                   "admin_command_start": "!бот ", "non_admin_answer": "нет", "admin_command_update": "update",
+                   "private_chat": -100, "debug_chat": -101, "google_table_users": "bench",
+                   "private_spammers": []}, cf, ensure_ascii=False)
+    lists = {}
+    for number in range(chats):
+        chat = -1000000000001 - number
+        path = os.path.join(root, 'chats', str(chat))
+        for directory in ('helper', 'msg_content', 'str_content'):
+            os.makedirs(os.path.join(path, directory))
+        commands = {}
+        for name in ('ping_words', 'rand_pervoe', 'ping_rand', 'goodbye'):
+            commands[name] = {"state": True, "answer_on": f"{name} on", "answer_off": f"{name} off"}
+        for name in ('notify_join', 'hello', 'spoilers', 'delete_join', 'night_mute', 'q&a'):
+            commands[name] = {"state": False, "answer_on": f"{name} on", "answer_off": f"{name} off"}
+        with open(os.path.join(path, 'config.json'), 'w', encoding='utf-8') as cf:
+            json.dump({"support_chat": chat - 500000000000, "admin_commands": commands}, cf, ensure_ascii=False)
+        chat_lists = {'curse_words': [make_word(rnd) for _ in range(words)],
+                      'ping_words': [make_word(rnd) for _ in range(max(words // 10, 1))],
+                      'delete_words': [make_word(rnd) for _ in range(max(words // 5, 1))],
+                      'ping_rand': ["понг", "пинг-понг"], 'rand_pervoe': ["сейчас"], 'goodbye': ["пока"]}
+        for name, values in chat_lists.items():
+            with open(os.path.join(path, 'str_content', f"{name}.txt"), 'w', encoding='utf-8') as sf:
+                sf.write('\n'.join(values))
+        for name in ('hello1', 'hello1_1'):
+            with open(os.path.join(path, 'msg_content', f"{name}.txt"), 'w', encoding='utf-8') as mf:
+                mf.write("Привет, {member_name}!")
+        chat_lists['helper'] = []
+        for position in range(helpers):
+            command = f"бот {make_word(rnd)}"
+            chat_lists['helper'].append(command)
+            with open(os.path.join(path, 'helper', f"h{position}.json"), 'w', encoding='utf-8') as hf:
+                json.dump({"command": command, "content": f"Ответ {position}",
+                           "delay": "Yes" if position % 10 == 0 else "No"}, hf, ensure_ascii=False)
+        chat_lists['rp_actions'] = ["обнять", "ударить", "погладить"]
+        with open(os.path.join(path, 'rp_actions.json'), 'w', encoding='utf-8') as rf:
+            json.dump({"обнять": "обнял(а)", "ударить": "ударил(а)", "погладить": "погладил(а)"}, rf,
+                      ensure_ascii=False)
+        lists[chat] = chat_lists
+    return lists
+
+
+def tree_lists(main):
+    """The trigger lists build_tree returns, read from the loaded chats of an existing bot directory"""
+    lists = {}
+    for chat in main.chats:
+        chat_my = main.chats[chat]
+        lists[chat] = {'curse_words': list(chat_my.curse_words), 'ping_words': list(chat_my.ping_words),
+                       'delete_words': list(chat_my.delete_words),
+                       'helper': [entity['command'] for entity in chat_my.helper],
+                       'rp_actions': list(chat_my.rp_actions)}
+    return lists
+
+
+def generate_updates(lists, count, seed, long_share=0):
+    """Group traffic: mostly plain chatter, some triggers (often disguised), helper requests, replies,
+    role-play commands, captions, edits and spam links in channel comments; long_share of the messages
+    are walls of text of 300-800 words"""
+    rnd = random.Random(seed)
+    chat_ids = sorted(lists)
+    updates = []
+    for update_id in range(1, count + 1):
+        chat = rnd.choice(chat_ids)
+        chat_lists = lists[chat]
+        user = {"id": 1000 + rnd.randrange(500), "is_bot": False, "first_name": f"user{rnd.randrange(500)}"}
+        words = [make_word(rnd, (1, 4), CHATTER_SYLLABLES) for _ in range(rnd.randint(3, 30))]
+        if long_share and rnd.random() < long_share:
+            words = [make_word(rnd, (1, 4), CHATTER_SYLLABLES) for _ in range(rnd.randint(300, 800))]
+        kind = rnd.random()
+        triggers = chat_lists['curse_words'] + chat_lists['ping_words'] + chat_lists['delete_words']
+        if kind < 0.06 and triggers:
+            trigger = rnd.choice(triggers)
+            words.insert(rnd.randrange(len(words) + 1), disguise(rnd, trigger) if rnd.random() < 0.5 else trigger)
+        elif kind < 0.09 and chat_lists['helper']:
+            words = rnd.choice(chat_lists['helper']).split()
+        message = {"message_id": update_id, "date": 1700000000 + update_id, "from": user,
+                   "chat": {"id": chat, "type": "supergroup", "title": "bench"}}
+        if 0.09 <= kind < 0.12:
+            message["photo"] = [{"file_id": "p", "file_unique_id": "p", "width": 10, "height": 10}]
+            message["caption"] = ' '.join(words)
+        else:
+            message["text"] = ' '.join(words)
+        if rnd.random() < 0.15:
+            original = {"message_id": update_id - 1, "date": 1700000000, "chat": message["chat"],
+                        "from": {"id": 2000, "is_bot": False, "first_name": "other"}, "text": "x"}
+            if kind >= 0.97:
+                # Спам в комментариях к посту канала
+                original["is_automatic_forward"] = True
+                message["text"] = f"{message.get('text', '')} https://spam.example"
+                message.pop("caption", None)
+                message.pop("photo", None)
+                message["entities"] = [{"type": "url", "offset": len(message["text"]) - 20, "length": 20}]
+            elif 'text' in message and chat_lists['rp_actions'] and rnd.random() < 0.3:
+                message["text"] = f"{rnd.choice(chat_lists['rp_actions'])} {message['text']}"
+            message["reply_to_message"] = original
+        edited = rnd.random() < 0.05 and 'text' in message
+        updates.append({"update_id": update_id, "edited_message" if edited else "message": message})
+    return updates
+
+
+def remap_chats(update, mapping):
+    """Moves a recorded update onto the synthetic chats: every group chat id goes through mapping"""
+    if isinstance(update, dict):
+        if update.get('type') in ('group', 'supergroup') and update.get('id') in mapping:
+            update = dict(update, id=mapping[update['id']])
+        return {key: remap_chats(value, mapping) for key, value in update.items()}
+    if isinstance(update, list):
+        return [remap_chats(value, mapping) for value in update]
+    return update
+
+
+def recorded_chats(update, found):
+    if isinstance(update, dict):
+        if update.get('type') in ('group', 'supergroup') and 'id' in update:
+            found.setdefault(update['id'])
+        for value in update.values():
+            recorded_chats(value, found)
+    elif isinstance(update, list):
+        for value in update:
+            recorded_chats(value, found)
+    return found
+
+
+class FakeRequest(BaseRequest):
+    """Answers Bot API calls locally and counts them by method; getUpdates hands out the queued updates"""
+    def __init__(self, updates=()):
+        self.calls = collections.Counter()
+        self.message_id = 0
+        self.updates = list(updates)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def message(self, chat_id):
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "supergroup" if int(chat_id) < 0 else "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"}, "text": "ok"}
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        # Настоящий запрос всегда отдает управление циклу; без этого опрос getUpdates в PTB 20.x его не отпускает
+        await asyncio.sleep(0)
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint == 'getMe':
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif endpoint in ('sendMessage', 'forwardMessage'):
+            result = self.message(parameters.get('chat_id', 0))
+        elif endpoint == 'copyMessage':
+            self.message_id += 1
+            result = {"message_id": self.message_id}
+        elif endpoint in ('forwardMessages', 'copyMessages'):
+            self.message_id += len(parameters.get('message_ids', []))
+            result = [{"message_id": self.message_id - position}
+                      for position in range(len(parameters.get('message_ids', [])))][::-1]
+        elif endpoint == 'getUpdates':
+            result, self.updates = self.updates, []
+        elif endpoint == 'getChatAdministrators':
+            result = [{"status": "creator", "is_anonymous": False,
+                       "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"}}]
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def micro(main, texts):
+    """Calls per second of the word checks main.py runs on every message"""
+    words = [word for text, chat in texts for word in text.split()]
+    checks = [("replace_letters", lambda: [main.replace_letters(word) for word in words], len(words)),
+              ("filter_word", lambda: [main.filter_word(text, chat) for text, chat in texts], len(texts)),
+              ("delete_word", lambda: [main.delete_word(text, chat) for text, chat in texts], len(texts)),
+              ("helper_find", lambda: [main.helper_find(main.chats[chat], text) for text, chat in texts],
+               len(texts))]
+    for name, run, calls in checks:
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        print(f"{name:>16}: {calls / elapsed:12.0f} calls/sec")
+
+
+def legacy_chain(main):
+    """The group message handler filters as main() registered them before the router, in the same order"""
+    config = main.bot_config
+    message = filters.ChatType.GROUPS & filters.UpdateType.MESSAGE
+    return [message & filters.Chat(-1001540432154) & filters.Regex(f"^Бусти https://boosty.to/"),
+            message & filters.Regex(f"^{config.admin_command_start}"),
+            message & filters.REPLY & filters.Regex(config.warn_keyword),
+            message & filters.REPLY & filters.Regex(f"^[M|m]ute"),
+            message & filters.REPLY & filters.Regex(f"Ban"),
+            message & filters.Regex(config.random_fun_keyword),
+            message & filters.Regex(config.random_game_keyword),
+            message & filters.Regex(config.helper_keyword),
+            filters.ChatType.GROUPS & filters.TEXT,
+            filters.ChatType.GROUPS & filters.CAPTION]
+
+
+def routing(main, updates, rounds=20):
+    """Microseconds per update to pick the group handler and resolve the chat: old filter chain vs GroupRouter"""
+    chain = legacy_chain(main)
+    router = main.build_group_router()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            for handler_filter in chain:
+                if handler_filter.check_update(update):
+                    # каждый обработчик сам искал свой чат
+                    chat = update.effective_chat.id if main.chats.get(update.effective_chat.id) is not None \
+                        else main.support_chats[update.effective_chat.id]
+                    break
+    legacy = (time.perf_counter() - started) / (rounds * len(updates))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            router.select(update)
+            chat = main.chat_key(update.effective_chat.id)
+    routed = (time.perf_counter() - started) / (rounds * len(updates))
+    print(f"routing: filter chain {legacy * 10 ** 6:.2f} us/update, router {routed * 10 ** 6:.2f} us/update")
+
+
+async def lag_sampler(lags, interval=0.01):
+    """How late the event loop wakes a sleeping task, sampled every interval"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(loop.time() - started - interval, 0))
+
+
+async def replay(main, updates, warmup):
+    request = FakeRequest()
+    application = Application.builder().token(BENCH_TOKEN).request(request).get_updates_request(FakeRequest()) \
+        .build()
+    main.add_handlers(application)
+    errors = collections.Counter()
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(count_error)
+    # Без лимитов Telegram: меряем работу бота, а не ожидание токенов
+    main.outbound = main.OutboundQueue(global_rate=10 ** 9, group_rate=10 ** 9, private_rate=10 ** 9,
+                                       chat_burst=10 ** 9, concurrency=64)
+    async with application:
+        for data in updates[:warmup]:
+            await application.process_update(Update.de_json(data, application.bot))
+        await main.outbound.join()
+        request.calls.clear()
+        errors.clear()
+
+        timed = [Update.de_json(data, application.bot) for data in updates[warmup:]]
+        latencies = []
+        lags = []
+        sampler = asyncio.create_task(lag_sampler(lags))
+        started = time.perf_counter()
+        for update in timed:
+            update_started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - update_started)
+            await asyncio.sleep(0)  # между апдейтами цикл событий свободен, как при приеме из сети
+        handled = time.perf_counter() - started
+        await main.outbound.join()
+        drained = time.perf_counter() - started
+        sampler.cancel()
+        pending_jobs = len(application.job_queue.jobs()) if application.job_queue is not None else 0
+    main.offload.close()
+    return timed, latencies, lags, handled, drained, request.calls, errors, pending_jobs
+
+
+def startup(main, update):
+    """Runs the bot as main() does, polling a fake getUpdates that returns one update, and stops after it"""
+    builder = Application.builder().token(BENCH_TOKEN).request(FakeRequest()) \
+        .get_updates_request(FakeRequest([update]))
+    application = main.build_application(builder)
+
+    async def stop(update, context):
+        context.application.stop_running()
+
+    application.add_handler(TypeHandler(Update, stop), group=1)
+    application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None, close_loop=False)
+    return main.first_update_time
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay updates through the bot's handlers against a fake Bot API")
+    parser.add_argument("--tree", help="existing bot directory (config.json and chats/) instead of a synthetic one")
+    parser.add_argument("--chats", type=int, default=10, help="synthetic chats")
+    parser.add_argument("--words", type=int, default=200, help="curse words per synthetic chat")
+    parser.add_argument("--helpers", type=int, default=50, help="helper entries per synthetic chat")
+    parser.add_argument("--updates", type=int, default=2000, help="generated updates to replay")
+    parser.add_argument("--corpus", help="recorded updates, one JSON update per line (see record_updates)")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the corpus this many times")
+    parser.add_argument("--warmup", type=int, default=200, help="updates replayed before timing starts")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic tree, the corpus and the bot")
+    parser.add_argument("--long-share", type=float, default=0, help="share of generated 300-800 word messages")
+    parser.add_argument("--offload", type=int, help="moderate texts at least this long in worker processes")
+    parser.add_argument("--workers", type=int, default=2, help="offload worker processes")
+    parser.add_argument("--startup", action="store_true",
+                        help="only measure the time from importing main.py to the first handled update")
+    args = parser.parse_args()
+
+    logging.getLogger("telegram").setLevel(logging.ERROR)
+    workdir = None
+    if args.tree:
+        os.chdir(args.tree)
+    else:
+        workdir = tempfile.TemporaryDirectory(prefix="bench-")
+        lists = build_tree(workdir.name, args.chats, args.words, args.helpers, args.seed)
+        os.chdir(workdir.name)
+
+    import main as bot_main  # читает config.json текущей директории при импорте
+
+    if args.startup:
+        update = generate_updates(lists, 1, args.seed)[0] if workdir is not None else \
+            {"update_id": 1, "message": {"message_id": 1, "date": int(time.time()), "text": "/start",
+                                         "chat": {"id": ADMIN_ID, "type": "private", "first_name": "admin"},
+                                         "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"}}}
+        first_update_time = startup(bot_main, update)
+        print(f"chats: {len(list(bot_main.chats))}, time to first update: {first_update_time * 1000:.1f} ms")
+        bot_main.sheet_log.close(timeout=1)
+        if workdir is not None:
+            os.chdir(os.path.dirname(workdir.name))
+            workdir.cleanup()
+        return
+
+    random.seed(args.seed)
+    bot_main.chats.discover()
+    started = time.perf_counter()
+    for chat in bot_main.chats:
+        bot_main.chats[chat]
+    print(f"chats: {len(list(bot_main.chats))}, loaded in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    if args.corpus:
+        with open(args.corpus, 'r', encoding='utf-8') as updf:
+            recorded = [json.loads(line) for line in updf if line.strip()]
+        if workdir is not None:
+            found = {}
+            for update in recorded:
+                recorded_chats(update, found)
+            synthetic = sorted(bot_main.chats)
+            mapping = {chat: synthetic[position % len(synthetic)] for position, chat in enumerate(found)}
+            recorded = [remap_chats(update, mapping) for update in recorded]
+        updates = []
+        for round_number in range(args.repeat):
+            for update in recorded:
+                updates.append(dict(update, update_id=len(updates) + 1))
+    else:
+        if workdir is None:
+            lists = tree_lists(bot_main)
+            if not lists:
+                parser.error(f"no chats in {args.tree}/chats to generate updates for, pass --corpus")
+        updates = generate_updates(lists, args.warmup + args.updates, args.seed, args.long_share)
+    warmup = min(args.warmup, len(updates) // 2)
+
+    if args.offload is not None:
+        bot_main.offload = bot_main.ModerationOffload(args.offload, args.workers)
+    timed, latencies, lags, handled, drained, calls, errors, pending_jobs = asyncio.run(
+        replay(bot_main, updates, warmup))
+    count = len(timed)
+    print(f"updates: {count}, {count / handled:.1f} msgs/sec in handlers, "
+          f"{count / drained:.1f} msgs/sec with the outbound queue drained")
+    print(f"handler latency p50: {percentile(latencies, 0.5) * 1000:.3f} ms, "
+          f"p99: {percentile(latencies, 0.99) * 1000:.3f} ms")
+    if lags:
+        print(f"event loop lag p99: {percentile(lags, 0.99) * 1000:.3f} ms, max: {max(lags) * 1000:.3f} ms")
+    print(f"API calls: {sum(calls.values())}, {sum(calls.values()) / count:.3f} per update, "
+          f"delayed helper replies pending: {pending_jobs}")
+    for endpoint, number in calls.most_common():
+        print(f"{endpoint:>24}: {number}")
+    for error, number in errors.most_common():
+        print(f"handler error {error}: {number}")
+
+    hits = sum(bot_main.chats[chat].verdicts.hits for chat in bot_main.chats)
+    misses = sum(bot_main.chats[chat].verdicts.misses for chat in bot_main.chats)
+    print(f"token verdict cache: {hits} hits, {misses} misses, hit ratio {hits / max(hits + misses, 1):.3f}")
+
+    texts = []
+    for update in timed:
+        message = update.effective_message
+        if message is not None and update.effective_chat.id in bot_main.chats and (message.text or message.caption):
+            texts.append((message.text or message.caption, update.effective_chat.id))
+    if texts:
+        micro(bot_main, texts)
+    group_updates = [update for update in timed if update.effective_chat is not None
+                     and update.effective_chat.type in ('group', 'supergroup')
+                     and update.effective_chat.id in bot_main.chats]
+    if group_updates:
+        routing(bot_main, group_updates)
+    bot_main.sheet_log.close(timeout=1)
+    if workdir is not None:
+        os.chdir(os.path.dirname(workdir.name))
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
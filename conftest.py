@@ -0,0 +1,16 @@
+import json
+import os
+import sys
+import tempfile
+
+# main.py reads config.json from the working directory on import, so the tests run from a scratch directory
+test_root = tempfile.mkdtemp(prefix="bot-tests-")
+with open(os.path.join(test_root, 'config.json'), 'w', encoding='utf-8') as cf:
+    json.dump({"telegram_token": "123:TEST", "helper_keyword": "^бот", "random_fun_keyword": "пинг",
+               "random_game_keyword": "^игра", "warn_keyword": "^Пред", "forward_pm": "10",
+               "admin_command_start": "!бот ", "non_admin_answer": "нет", "admin_command_update": "update",
+               "private_chat": "-100", "debug_chat": -101, "google_table_users": "test",
+               "private_spammers": []}, cf, ensure_ascii=False)
+os.makedirs(os.path.join(test_root, 'chats'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(test_root)
@@ -9,9 +9,23 @@ Usage:
 Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import copy
 import datetime
+import functools
 import os
 import logging
+import pickle
+import queue
+import shutil
+import sqlite3
+import string
+import sys
+import tempfile
+import threading
 from typing import Optional, Tuple
 
 import pytz
@@ -22,7 +36,7 @@ try:
 except ImportError:
     __version_info__ = (0, 0, 0, 0, 0)  # type: ignore[assignment]
 
-if __version_info__ < (20, 0, 0, "alpha", 1):
+if __version_info__ < (20, 8):  # forward_messages, BaseUpdateProcessor
     raise RuntimeError(
         f"This example is not compatible with your current PTB version {TG_VER}. To view the "
         f"{TG_VER} version of this example, "
@@ -30,17 +44,25 @@ if __version_info__ < (20, 0, 0, "alpha", 1):
     )
 from telegram import Chat, ChatMember, ChatMemberUpdated, Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, ChatMemberHandler, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.error import RetryAfter
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, \
+    ContextTypes, MessageHandler, PersistenceInput, TypeHandler, filters
 import time
 import random
 import re
-from fuzzywuzzy import fuzz
+import itertools
+from itertools import groupby
+from fuzzywuzzy import fuzz, utils
 import json
 
 
 import gspread  # импортируем библиотеку для работы с гугл таблицами
 
 
+process_started = time.monotonic()
+first_update_time = None
+background_tasks = set()
+
 # Enable logging
 
 logging.basicConfig(
@@ -86,24 +108,114 @@ dict_re = {
 
 # Регулярки для замены похожих букв и символов на русские
 
-def bot_config_read():
-    with open('config.json', 'r', encoding='utf-8') as cf:
-        js = cf.read()
-        cf.close()
-    return json.loads(js)
+def letters_table_build(letters_re):
+    """Fold the sequential dict_re substitutions into one str.translate table"""
+    table = {}
+    for char in {char for value in letters_re.values() for char in value}:
+        folded = char
+        for key, value in letters_re.items():
+            folded = re.sub(value, key, folded)
+        if folded != char:
+            table[ord(char)] = folded
+    return table
+
+
+letters_table = letters_table_build(dict_re)
+
+
+def replace_letters(word=None):
+    return word.lower().translate(letters_table)
+
 
+def normalize_word(word):
+    """Collapse repeated characters ("Приииииивет" -> "Привет") and fold look-alike letters in one pass"""
+    return ''.join(char for char, _ in groupby(word)).lower().translate(letters_table)
 
-def bot_config_writer(config_dict):
-    json_object = json.dumps(config_dict.__dict__, ensure_ascii=False, indent=4)
-    with open("config.json", "w", encoding='utf-8') as outfile:
+
+class ContentCache:
+    """Parsed file contents by path, re-read only when the file's mtime or size changes"""
+    def __init__(self):
+        self.files = {}
+
+    def read(self, path, parser):
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.files.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            content = parser(f.read())
+        self.files[path] = (signature, content)
+        return content
+
+
+content_cache = ContentCache()
+
+
+def json_write_atomic(path, json_object):
+    """Writes to a temporary file next to path and renames it over, so a crash never leaves half a file"""
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path) or '.', suffix='.tmp',
+                                     delete=False) as outfile:
         outfile.write(json_object)
-        outfile.close()
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    try:
+        shutil.copymode(path, outfile.name)
+    except FileNotFoundError:
+        pass
+    os.replace(outfile.name, path)
+
+
+class ConfigWriter:
+    """Debounced config persistence: changes made within `delay` seconds are merged into one write of the
+    latest state, serialized on the loop and written from a thread"""
+    def __init__(self, delay=1):
+        self.delay = delay
+        self.pending = {}
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def schedule(self, path, config_dict):
+        self.pending[path] = config_dict
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (скрипты, консоль) пишем сразу
+            for pending_path, json_object in self.take():
+                json_write_atomic(pending_path, json_object)
+            return
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.flush_later())
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        return [(path, json.dumps(config_dict, ensure_ascii=False, indent=4)) for path, config_dict in pending.items()]
+
+    async def flush_later(self):
+        while self.pending:
+            await asyncio.sleep(self.delay)
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            for path, json_object in self.take():
+                await asyncio.to_thread(json_write_atomic, path, json_object)
+
+
+config_writer = ConfigWriter()
+
+
+def bot_config_read():
+    # Копия: вызывающий код может менять конфиг на лету, кеш портить нельзя
+    return copy.deepcopy(content_cache.read('config.json', json.loads))
 
 
 class UserConfig:
     def __init__(self, telegram_token, helper_keyword, random_fun_keyword, random_game_keyword, warn_keyword,
                  forward_pm, admin_command_start, non_admin_answer, admin_command_update, private_chat, debug_chat,
-                 google_table_users, private_spammers):
+                 google_table_users, private_spammers, admin_command_cancel="cancel", webhook=None,
+                 concurrent_updates=8, record_updates=None, metrics=None, state_file="bot_state.sqlite3",
+                 blocklist_file="private_spammers.log", moderation_offload=None):
         self.telegram_token = telegram_token
         self.helper_keyword = helper_keyword
         self.random_fun_keyword = random_fun_keyword
@@ -117,6 +229,14 @@ class UserConfig:
         self.debug_chat = debug_chat
         self.google_table_users = google_table_users
         self.private_spammers = private_spammers
+        self.admin_command_cancel = admin_command_cancel
+        self.webhook = webhook
+        self.concurrent_updates = concurrent_updates
+        self.record_updates = record_updates
+        self.metrics = metrics
+        self.state_file = state_file
+        self.blocklist_file = blocklist_file
+        self.moderation_offload = moderation_offload
 
 
 def bot_config_load():
@@ -134,75 +254,166 @@ def bot_config_load():
                     config_content["private_chat"],
                     config_content["debug_chat"],
                     config_content["google_table_users"],
-                    config_content["private_spammers"])
+                    config_content.get("private_spammers", []),
+                    config_content.get("admin_command_cancel", "cancel"),
+                    config_content.get("webhook"),
+                    config_content.get("concurrent_updates", 8),
+                    config_content.get("record_updates"),
+                    config_content.get("metrics"),
+                    config_content.get("state_file", "bot_state.sqlite3"),
+                    config_content.get("blocklist_file", "private_spammers.log"),
+                    config_content.get("moderation_offload"))
     return my_bot_config
 
 
 bot_config = bot_config_load()
-gs = gspread.service_account(filename='agile-splicer-401313-81027a7c3f21.json')  # подключаем файл с ключами и пр.
-sh = gs.open_by_key(bot_config.google_table_users)  # подключаем таблицу по ID
-worksheet = sh.sheet1  # получаем первый лист
 
-chat_list = os.listdir("chats")
+
+def sheet_connect():
+    gs = gspread.service_account(filename='agile-splicer-401313-81027a7c3f21.json')  # подключаем файл с ключами и пр.
+    sh = gs.open_by_key(bot_config.google_table_users)  # подключаем таблицу по ID
+    return sh.sheet1  # получаем первый лист
+
+
+class SheetLogWriter:
+    """Appends moderation log rows to the sheet from a background thread, in batches.
+    Until a worksheet is connected the rows are kept in memory, up to buffer_limit."""
+    def __init__(self, worksheet=None, batch_size=20, flush_interval=5, retries=5, retry_delay=1, buffer_limit=1000):
+        self.worksheet = worksheet
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.buffer_limit = buffer_limit
+        self.rows = queue.Queue()
+        self.thread = None
+
+    def put(self, row):
+        # Поток мог упасть - запускаем заново, строки в очереди не теряются
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name="sheet-log", daemon=True)
+            self.thread.start()
+        self.rows.put(row)
+
+    def run(self):
+        batch = []
+        stop = False
+        while not stop:
+            # Ждем остальные строки пачки, но не дольше flush_interval после первой
+            deadline = time.monotonic() + self.flush_interval if batch else None
+            while not stop and (len(batch) < self.batch_size or self.worksheet is None):
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    row = self.rows.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                else:
+                    batch.append(row)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            if batch and self.write(batch):
+                batch = []
+            if len(batch) > self.buffer_limit:
+                logger.error("Sheet log rows dropped: %s", batch[:-self.buffer_limit])
+                del batch[:-self.buffer_limit]
+        if batch:
+            logger.error("Sheet log rows were not written: %s", batch)
+
+    def write(self, batch):
+        if self.worksheet is None:
+            return False
+        delay = self.retry_delay
+        for attempt in range(self.retries):
+            try:
+                self.worksheet.append_rows(batch)
+                return True
+            except Exception as error:  # любая ошибка не должна останавливать поток записи
+                logger.warning("Sheet log append failed (attempt %s): %s", attempt + 1, error)
+                time.sleep(delay)
+                delay *= 2
+        logger.error("Sheet log rows dropped: %s", batch)
+        return True
+
+    def close(self, timeout=30):
+        """Flushes queued rows and stops the writer thread"""
+        if self.thread is None:
+            return
+        self.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+
+sheet_log = SheetLogWriter()
+
+
+async def sheet_log_connect():
+    """Connects the sheet in the background; while Sheets is down the log rows stay buffered"""
+    delay = 30
+    while sheet_log.worksheet is None:
+        try:
+            sheet_log.worksheet = await asyncio.to_thread(sheet_connect)
+        except Exception as error:  # ключ, авторизация, сеть - бот работает и без таблицы
+            logger.warning("Google Sheets is unavailable, retrying in %s s: %s", delay, error)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 600)
+
+
+def content_files(directory):
+    """Files directly in the directory, nothing if it does not exist"""
+    try:
+        return [entry for entry in os.scandir(directory) if entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def helper_parse(js_h):
+    try:
+        return json.loads(js_h, strict=False)
+    except json.decoder.JSONDecodeError:
+        logger.error(json.decoder.JSONDecodeError)
+        print(js_h)
+        return None
 
 
 def my_helper_read(chat):
     file_helper_list = []
-    for root, dirs, files in os.walk(f"chats/{chat}/helper"):
-        for filename in files:
-            with open(f"chats/{chat}/helper/" + filename, 'r', encoding="utf-8") as helperf:
-                js_h = helperf.read()
-                helperf.close()
-            try:
-                helper_ent = json.loads(js_h, strict=False)
-                file_helper_list.append(helper_ent)
-            except json.decoder.JSONDecodeError:
-                logger.error(json.decoder.JSONDecodeError)
-                print(js_h)
+    for entry in content_files(f"chats/{chat}/helper"):
+        helper_ent = content_cache.read(entry.path, helper_parse)
+        if helper_ent is not None:
+            file_helper_list.append(helper_ent)
     return file_helper_list
 
 
 def my_msg_content_read(chat):
     file_msg_content = {}
-    for root, dirs, files in os.walk(f"chats/{chat}/msg_content"):
-        for filename in files:
-            with open(f"chats/{chat}/msg_content/" + filename, 'r', encoding="utf-8") as msgf:
-                msgc = msgf.read()
-                msgf.close()
-            file_msg_content[filename[:filename.rfind('.')].lower()] = msgc
+    for entry in content_files(f"chats/{chat}/msg_content"):
+        file_msg_content[entry.name[:entry.name.rfind('.')].lower()] = content_cache.read(entry.path, str)
     return file_msg_content
 
 
 def my_str_content_read(chat):
     file_str_content = {}
-    for root, dirs, files in os.walk(f"chats/{chat}/str_content"):
-        for filename in files:
-            with open(f"chats/{chat}/str_content/" + filename, 'r', encoding="utf-8") as strf:
-                strc = list(filter(None, strf.read().split('\n')))
-                strf.close()
-            file_str_content[filename[:filename.rfind('.')].lower()] = strc
+    for entry in content_files(f"chats/{chat}/str_content"):
+        strc = content_cache.read(entry.path, lambda text: list(filter(None, text.split('\n'))))
+        file_str_content[entry.name[:entry.name.rfind('.')].lower()] = strc
     return file_str_content
 
 
 def my_rp_actions_read(chat):
-    with open(f"chats/{chat}/rp_actions.json", 'r', encoding='utf-8') as rpf:
-        js = rpf.read()
-        rpf.close()
-    return json.loads(js)
+    return content_cache.read(f"chats/{chat}/rp_actions.json", json.loads)
 
 
 def chat_config_read(chat):
-    with open(f"chats/{chat}/config.json", 'r', encoding='utf-8') as cf:
-        js = cf.read()
-        cf.close()
-    return json.loads(js)
+    # Копия: admin_commands меняются на лету и не должны портить кеш
+    return copy.deepcopy(content_cache.read(f"chats/{chat}/config.json", json.loads))
 
 
 def chat_config_writer(config_dict, chat):
-    json_object = json.dumps(config_dict, ensure_ascii=False, indent=4)
-    with open(f"chats/{chat}/config.json", "w", encoding='utf-8') as outfile:
-        outfile.write(json_object)
-        outfile.close()
+    config_writer.schedule(f"chats/{chat}/config.json", config_dict)
 
 
 def chat_content_load(chat):
@@ -225,6 +436,164 @@ def chat_content_load(chat):
     return my_chat
 
 
+class WordMatcher:
+    """Trigger words indexed for fuzz.token_sort_ratio: exact hits by hash, fuzzy ones only among plausible lengths"""
+    def __init__(self, words, threshold):
+        self.words = words
+        self.threshold = threshold
+        self.exact = {}
+        self.lengths = {}
+        for position, word in enumerate(words):
+            key = self.sort_key(word)
+            self.exact.setdefault(key, set()).add(position)
+            self.lengths.setdefault(len(key), []).append(position)
+
+    @staticmethod
+    def sort_key(word):
+        """The string token_sort_ratio really compares"""
+        return ' '.join(sorted(utils.full_process(word, force_ascii=True).split()))
+
+    def candidates(self, key):
+        # ratio() не может превысить 2 * min(a, b) / (a + b), а для разных строк одной длины - (2a - 1) / 2a
+        size = len(key)
+        positions = set(self.exact.get(key, ()))
+        for length, bucket in self.lengths.items():
+            common = 2 * min(size, length) - (size == length)
+            if 200 * common >= (2 * self.threshold - 1) * (size + length):
+                positions.update(bucket)
+        return sorted(positions)
+
+    def match(self, w):
+        """Returns (trigger word, percent) for the first word in list order that reaches the threshold"""
+        key = self.sort_key(w)
+        exact = self.exact.get(key, ())
+        for position in self.candidates(key):
+            word = self.words[position]
+            b = 100 if position in exact else fuzz.token_sort_ratio(word, w)
+            if b >= self.threshold:
+                return word, b
+        return None
+
+
+def trigger_matchers(ping_words, curse_words, delete_words):
+    """Matchers of a chat's trigger lists by kind, the same in the bot and in offload workers"""
+    return {'ping': WordMatcher(ping_words, 100), 'curse': WordMatcher(curse_words, 87),
+            'delete': WordMatcher(delete_words, 100)}
+
+
+class TokenVerdict:
+    """A token normalized once, with its trigger list matches filled in on demand"""
+    __slots__ = ('word', 'matches')
+
+    def __init__(self, word):
+        self.word = word
+        self.matches = {}
+
+
+VERDICT_CACHE_SIZE = 20000
+
+
+class TokenVerdicts:
+    """Per-chat LRU cache: raw token -> TokenVerdict. Belongs to ChatMy, so reloading the chat's
+    word lists starts a new cache; ping matches are kept whatever the ping_words toggle says"""
+    def __init__(self, matchers, size=VERDICT_CACHE_SIZE):
+        self.matchers = matchers
+        self.size = size
+        self.verdicts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def token(self, raw):
+        verdict = self.verdicts.get(raw)
+        if verdict is None:
+            self.misses += 1
+            verdict = self.verdicts[raw] = TokenVerdict(normalize_word(raw))
+            if len(self.verdicts) > self.size:
+                self.verdicts.popitem(last=False)
+        else:
+            self.hits += 1
+            self.verdicts.move_to_end(raw)
+        return verdict
+
+    def tokens(self, msg):
+        """Verdicts for the message words, each normalized word once"""
+        distinct = {}
+        for raw in msg.split():
+            verdict = self.token(raw)
+            distinct.setdefault(verdict.word, verdict)
+        return list(distinct.values())
+
+    def match(self, verdict, kind):
+        """(trigger word, percent) or None from the kind's matcher: ping, curse or delete"""
+        if kind not in verdict.matches:
+            verdict.matches[kind] = self.matchers[kind].match(verdict.word)
+        return verdict.matches[kind]
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+RP_COOLDOWN = 5
+
+
+class RpTemplate:
+    """Role-play message template parsed once; {actor}, {target} and {rest} are filled in per message"""
+    fields = ('actor', 'target', 'rest')
+
+    def __init__(self, template):
+        self.parts = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if field is not None and (field not in self.fields or format_spec or conversion):
+                raise ValueError(f"unknown template field {{{field}}}")
+            self.parts.append((literal, field))
+
+    def render(self, values):
+        return ''.join(literal if field is None else literal + values[field] for literal, field in self.parts)
+
+
+class RpActions:
+    """Role-play commands of a chat by lowercased trigger. rp_actions.json maps a trigger (one or several words)
+    to a text put before the target's mention, or to {"template": "...", "aliases": [...]}"""
+    def __init__(self, rp_actions, cooldown=RP_COOLDOWN):
+        self.index = {}
+        for trigger, action in rp_actions.items():
+            if isinstance(action, str):
+                # Старый формат: текст как есть, фигурные скобки в нем не поля
+                action = {"template": action.replace('{', '{{').replace('}', '}}') + " {target} {rest}"}
+            try:
+                template = RpTemplate(action['template'])
+            except (KeyError, TypeError, ValueError) as error:
+                logger.error("Role-play action %s skipped: %s", trigger, error)
+                continue
+            for name in [trigger] + action.get('aliases', []):
+                self.index.setdefault(' '.join(name.lower().split()), template)
+        self.max_words = max((len(name.split()) for name in self.index), default=0)
+        self.cooldown = cooldown
+        self.last_used = {}
+
+    def find(self, words):
+        """(template, trigger length in words) for the message words, the longest trigger first"""
+        for size in range(min(len(words), self.max_words), 0, -1):
+            template = self.index.get(' '.join(words[:size]).lower())
+            if template is not None:
+                return template, size
+        return None
+
+    def allow(self, user_id):
+        """False while the user's cooldown is running, otherwise starts it"""
+        now = time.monotonic()
+        if now - self.last_used.get(user_id, now - self.cooldown) < self.cooldown:
+            return False
+        if len(self.last_used) > 1000:
+            self.last_used = {user: used for user, used in self.last_used.items() if now - used < self.cooldown}
+        self.last_used[user_id] = now
+        return True
+
+
+chat_versions = itertools.count()
+
+
 class ChatMy:
     def __init__(self, chat, hello, hello_spoil, goodbye, curse_words, ping_words, delete_words, ping_rand, rand_pervoe,
                  chat_helper, rp_actions, admin_commands, support_chat):
@@ -236,29 +605,78 @@ class ChatMy:
         self.curse_words = curse_words
         self.ping_words = ping_words
         self.delete_words = delete_words
+        self.matchers = trigger_matchers(ping_words, curse_words, delete_words)
+        self.verdicts = TokenVerdicts(self.matchers)
+        self.version = next(chat_versions)
         self.ping_rand = ping_rand
         self.rand_pervoe = rand_pervoe
 
         self.helper = chat_helper
+        self.helper_index = {}
+        self.helper_prefixes = {}
+        for helper_entity in chat_helper:
+            for command in [helper_entity['command']] + helper_entity.get('aliases', []):
+                keyword = replace_letters(command)
+                self.helper_index.setdefault(keyword, helper_entity)
+                if len(keyword.split()) > 1:
+                    self.helper_prefixes.setdefault(' '.join(keyword.split()), helper_entity)
+        self.helper_prefix_words = max((len(keyword.split()) for keyword in self.helper_prefixes), default=0)
         self.rp_actions = rp_actions
+        self.rp_index = RpActions(rp_actions)
 
         self.admin_commands = admin_commands
         self.support_chat = support_chat
 
 
-chats = {}
-support_chats = {}
+class ChatStore:
+    """Chats from the chats/ directory: configs are read up front, content is loaded on first use"""
+    def __init__(self, root="chats"):
+        self.root = root
+        self.chat_ids = {}
+        self.loaded = {}
+
+    def discover(self):
+        self.chat_ids = dict.fromkeys(int(name) for name in os.listdir(self.root))
+        for chat in self.chat_ids:
+            support_chat = chat_config_read(chat)['support_chat']
+            support_chats[support_chat] = chat
+            print(chat, support_chat)
+
+    def __iter__(self):
+        return iter(self.chat_ids)
+
+    def __contains__(self, chat):
+        return chat in self.chat_ids
+
+    def __getitem__(self, chat):
+        my_chat = self.loaded.get(chat)
+        if my_chat is None:
+            if chat not in self.chat_ids:
+                raise KeyError(chat)
+            my_chat = self.loaded[chat] = chat_content_load(chat)
+        return my_chat
+
+    def get(self, chat, default=None):
+        if chat not in self.chat_ids:
+            return default
+        return self[chat]
 
+    def reload(self, chat):
+        """Rebuilds the chat, re-reading only the files changed since the last load"""
+        my_chat = self.loaded[chat] = chat_content_load(chat)
+        support_chats[my_chat.support_chat] = chat
+        return my_chat
 
-for user_chat_id in chat_list:
-    chats[int(user_chat_id)] = chat_content_load(user_chat_id)
-    support_chats[chats[int(user_chat_id)].support_chat] = int(user_chat_id)
 
-for dict_key in chats:
-    user_chat_id = chats[dict_key]
-    print(dict_key, user_chat_id.support_chat, user_chat_id.rp_actions)
+chats = ChatStore()
+support_chats = {}
+
 
-ignore = []
+def chat_key(chat_id):
+    """The chats/ entry the chat belongs to: the chat itself or the chat it is the support chat of"""
+    if chat_id in chats:
+        return chat_id
+    return support_chats[chat_id]
 
 
 def extract_status_change(chat_member_update: ChatMemberUpdated) -> Optional[Tuple[bool, bool]]:
@@ -287,81 +705,471 @@ def extract_status_change(chat_member_update: ChatMemberUpdated) -> Optional[Tup
     return was_member, is_member
 
 
-def replace_letters(word=None):
-    word = word.lower()
-    for key, value in dict_re.items():
-        word = re.sub(value, key, word)
-    return word
+def find_delete_word(tokens, chat_my):
+    for token in tokens:
+        found = chat_my.verdicts.match(token, 'delete')  # Проверяю сходство слов из списка
+        if found is not None:
+            word, b = found
+            return f"{token.word} | {b}% Слово-триггер: {word}"
+    return False
 
 
-def delete_word(msg, chat):
-    if chats.get(chat) is not None:
-        pass
-    else:
-        chat = support_chats[chat]
-    msg = msg.split()
-    for w in msg:
-        w = ''.join([w[i] for i in range(len(w) - 1) if w[i + 1] != w[i]] + [
-            w[-1]]).lower()  # Здесь убираю символы которые повторяються "Приииииивет" -> "Привет"
-        w = replace_letters(w)
-
-        for word in chats[chat].delete_words:
-            b = fuzz.token_sort_ratio(word, w)  # Проверяю сходство слов из списка
-            if b >= 100:
-                return f"{w} | {b}% Слово-триггер: {word}"
-            else:
-                pass
+def find_trigger_word(tokens, chat_my):
+    for token in tokens:
+        '''admin trigger words'''
+        if chat_my.admin_commands["ping_words"]["state"] is True:
+            found = chat_my.verdicts.match(token, 'ping')  # Проверяю сходство слов из списка
+            if found is not None:
+                word, b = found
+                return f"{token.word} | {b}% Слово-триггер: {word}"
+
+        found = chat_my.verdicts.match(token, 'curse')
+        if found is not None:
+            word, b = found
+            return f"{token.word} | {b}% Слово-триггер: {word}"
     return False
 
 
+def delete_word(msg, chat):
+    chat = chat_key(chat)
+    return find_delete_word(chats[chat].verdicts.tokens(msg), chats[chat])
+
+
 def filter_word(msg, chat):
-    if chats.get(chat) is not None:
+    chat = chat_key(chat)
+    return find_trigger_word(chats[chat].verdicts.tokens(msg), chats[chat])
+
+
+class Histogram:
+    """Prometheus-style histogram: per-bucket counts, sum and count"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cumulative}')
+        labels = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{labels} {self.sum}')
+        lines.append(f'{name}_count{labels} {self.count}')
+        return lines
+
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Metrics:
+    """Handler timings, triggers per chat, outbound call latency and event loop lag, in Prometheus text format"""
+    def __init__(self):
+        self.handlers = {}
+        self.triggers = collections.Counter()
+        self.outbound = Histogram(LATENCY_BUCKETS)
+        self.loop_lag = Histogram(LATENCY_BUCKETS)
+        self.loop_lag_max = 0.0
+        self.server = None
+
+    def observe_handler(self, name, seconds):
+        histogram = self.handlers.get(name)
+        if histogram is None:
+            histogram = self.handlers[name] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def count_trigger(self, chat, kind):
+        self.triggers[chat, kind] += 1
+
+    def render(self):
+        lines = ['# TYPE bot_handler_seconds histogram']
+        for name, histogram in sorted(self.handlers.items()):
+            lines += histogram.render('bot_handler_seconds', f'handler="{name}"')
+        lines.append('# TYPE bot_triggers_total counter')
+        for (chat, kind), count in sorted(self.triggers.items()):
+            lines.append(f'bot_triggers_total{{chat="{chat}",kind="{kind}"}} {count}')
+        lines.append('# TYPE bot_outbound_seconds histogram')
+        lines += self.outbound.render('bot_outbound_seconds', '')
+        stats = outbound.stats()
+        for key in ('sent', 'errors', 'flood_waits'):
+            lines.append(f'# TYPE bot_outbound_{key}_total counter')
+            lines.append(f'bot_outbound_{key}_total {stats[key]}')
+        for key in ('depth_moderation', 'depth_normal', 'depth_low', 'in_flight'):
+            lines.append(f'# TYPE bot_outbound_{key} gauge')
+            lines.append(f'bot_outbound_{key} {stats[key]}')
+        for name in ('hits', 'misses'):
+            lines.append(f'# TYPE bot_verdict_cache_{name}_total counter')
+            for chat, chat_my in sorted(chats.loaded.items()):
+                lines.append(f'bot_verdict_cache_{name}_total{{chat="{chat}"}} {getattr(chat_my.verdicts, name)}')
+        lines.append('# TYPE bot_verdict_cache_size gauge')
+        for chat, chat_my in sorted(chats.loaded.items()):
+            lines.append(f'bot_verdict_cache_size{{chat="{chat}"}} {len(chat_my.verdicts.verdicts)}')
+        lines.append('# TYPE bot_verdict_cache_hit_ratio gauge')
+        for chat, chat_my in sorted(chats.loaded.items()):
+            lines.append(f'bot_verdict_cache_hit_ratio{{chat="{chat}"}} {chat_my.verdicts.hit_ratio():.4f}')
+        lines.append('# TYPE bot_loop_lag_seconds histogram')
+        lines += self.loop_lag.render('bot_loop_lag_seconds', '')
+        lines.append('# TYPE bot_loop_lag_max_seconds gauge')
+        lines.append(f'bot_loop_lag_max_seconds {self.loop_lag_max}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def timed(name):
+    """Records the run time of an async handler in metrics under the given name"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                metrics.observe_handler(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+async def loop_lag_monitor(interval=0.5):
+    """Measures how late the event loop wakes up a sleeping task: the time some handler held the loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - started - interval, 0)
+        metrics.loop_lag.observe(lag)
+        metrics.loop_lag_max = max(metrics.loop_lag_max, lag)
+
+
+async def metrics_serve(reader, writer):
+    """GET /metrics over plain HTTP, one request per connection"""
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        if request.split(b' ')[:2] == [b'GET', b'/metrics']:
+            body = metrics.render().encode()
+            status = b'200 OK'
+        else:
+            body = b'Not found\n'
+            status = b'404 Not Found'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
         pass
-    else:
-        chat = support_chats[chat]
-    msg = msg.split()
-    for w in msg:
-        w = ''.join([w[i] for i in range(len(w) - 1) if w[i + 1] != w[i]] + [
-            w[-1]]).lower()  # Здесь убираю символы которые повторяються "Приииииивет" -> "Привет"
-        w = replace_letters(w)
-
-        '''admin trigger words'''
-        if chats[chat].admin_commands["ping_words"]["state"] is True:
-            for word in chats[chat].ping_words:
-                b = fuzz.token_sort_ratio(word, w)  # Проверяю сходство слов из списка
-                if b >= 100:
-                    return f"{w} | {b}% Слово-триггер: {word}"
-                else:
-                    pass
+    finally:
+        writer.close()
+
+
+PRIORITY_MODERATION = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # приветствия, прощания, развлечения
+OUTBOUND_STOP_TIMEOUT = 10  # секунд на отправку очереди при остановке бота
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Seconds until a token is available, 0 if one is"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundAction:
+    def __init__(self, chat_id, call, priority, limited, after, future):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.limited = limited
+        self.after = after
+        self.future = future
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """Outbound Bot API calls under Telegram's flood limits.
+    Calls to one chat go one at a time in submission order (per priority), chats are served concurrently,
+    moderation goes before everything else. Each chat has its own message budget (20 per minute in groups,
+    one per second in private chats), all chats share the global one. A 429 pauses the chat for retry_after
+    and the call is repeated, unless retry_after is longer than max_retry_after: then the call fails."""
+    def __init__(self, global_rate=30, group_rate=20 / 60, private_rate=1, chat_burst=3, concurrency=8,
+                 max_attempts=3, max_retry_after=60):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.max_retry_after = max_retry_after
+        self.pending = {PRIORITY_MODERATION: [], PRIORITY_NORMAL: [], PRIORITY_LOW: []}
+        self.chat_buckets = {}
+        self.paused = {}
+        self.busy = set()
+        self.sending = set()
+        self.wakeup = None
+        self.task = None
+        self.sent = 0
+        self.errors = 0
+        self.flood_waits = 0
+
+    def submit(self, chat_id, call, priority=PRIORITY_NORMAL, limited=True, after=None):
+        """Queues call() for the chat and returns its future.
+        limited=False is for calls that are not messages (delete, restrict) and skip the chat budget;
+        after is another action's future this one has to wait for."""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self.report)
+        # id из конфига может быть строкой, а бюджет чата выбирается по знаку
+        self.pending[priority].append(OutboundAction(int(chat_id), call, priority, limited, after, future))
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        if after is not None and not after.done():
+            after.add_done_callback(lambda _: self.wakeup.set())
+        self.wakeup.set()
+        return future
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def dispatch(self):
+        """Starts every action allowed to go now; returns seconds until the next one may be ready"""
+        now = time.monotonic()
+        wait = None
+        for priority, actions in self.pending.items():
+            held = set()
+            kept = []
+            for action in actions:
+                if action.future.done():  # отменено вызывающим
+                    continue
+                try:
+                    chat_id = action.chat_id
+                    after = action.after
+                    if after is not None and after.done() and (after.cancelled() or after.exception() is not None):
+                        raise RuntimeError("The outbound action it waited for has failed")
+                    delay = 0
+                    if after is not None and not after.done():
+                        # Ждет другое действие, не занимая ни чат, ни слот: его разбудит колбэк after
+                        delay = None
+                    elif chat_id in held or chat_id in self.busy or len(self.busy) >= self.concurrency:
+                        delay = None
+                    elif self.paused.get(chat_id, 0) > now:
+                        delay = self.paused[chat_id] - now
+                    elif action.limited and self.chat_bucket(chat_id).delay(now) > 0:
+                        delay = self.chat_bucket(chat_id).delay(now)
+                    elif self.global_bucket.delay(now) > 0:
+                        delay = self.global_bucket.delay(now)
+                    if delay != 0:
+                        # Следующие действия этого чата ждут своей очереди
+                        held.add(chat_id)
+                        kept.append(action)
+                        if delay is not None:
+                            wait = delay if wait is None else min(wait, delay)
+                        continue
+                    self.global_bucket.take()
+                    if action.limited:
+                        self.chat_bucket(chat_id).take()
+                    self.busy.add(chat_id)
+                    task = asyncio.create_task(self.send(action))
+                    self.sending.add(task)
+                    task.add_done_callback(self.sending.discard)
+                except Exception as error:  # одно сломанное действие не останавливает очередь
+                    self.errors += 1
+                    action.future.set_exception(error)
+            self.pending[priority] = kept
+        return wait
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            wait = self.dispatch()
+            if not self.depth() and not self.busy:
+                break
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
 
-        for word in chats[chat].curse_words:
-            b = fuzz.token_sort_ratio(word, w)  # Проверяю сходство слов из списка
-            if b >= 87:
-                return f"{w} | {b}% Слово-триггер: {word}"
+    async def send(self, action):
+        try:
+            action.attempts += 1
+            started = time.perf_counter()
+            result = await action.call()
+            metrics.outbound.observe(time.perf_counter() - started)
+            action.future.set_result(result)
+            self.sent += 1
+        except RetryAfter as error:
+            retry_after = error.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            self.flood_waits += 1
+            self.paused[action.chat_id] = time.monotonic() + retry_after
+            if action.attempts < self.max_attempts and retry_after <= self.max_retry_after:
+                self.pending[action.priority].insert(0, action)
             else:
-                pass
-    return False
+                self.errors += 1
+                action.future.set_exception(error)
+        except Exception as error:  # ошибка уходит в future, очередь продолжает работу
+            self.errors += 1
+            action.future.set_exception(error)
+        finally:
+            self.busy.discard(action.chat_id)
+            self.wakeup.set()
+
+    @staticmethod
+    def report(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Outbound action failed: %s", future.exception())
+
+    def depth(self):
+        return sum(len(actions) for actions in self.pending.values())
+
+    def stats(self):
+        """Queue depth and counters for monitoring"""
+        return {
+            'depth': self.depth(),
+            'depth_moderation': len(self.pending[PRIORITY_MODERATION]),
+            'depth_normal': len(self.pending[PRIORITY_NORMAL]),
+            'depth_low': len(self.pending[PRIORITY_LOW]),
+            'in_flight': len(self.busy),
+            'sent': self.sent,
+            'errors': self.errors,
+            'flood_waits': self.flood_waits,
+        }
+
+    async def join(self):
+        """Waits until every queued action has been sent"""
+        while self.task is not None and not self.task.done():
+            await asyncio.shield(self.task)
+
+    def drop(self, priority):
+        """Cancels the queued actions of the priority, returns how many there were"""
+        actions = self.pending[priority]
+        self.pending[priority] = []
+        for action in actions:
+            action.future.cancel()
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return len(actions)
+
+    async def stop(self, timeout):
+        """Drains the queue on shutdown: low priority actions are dropped right away, the rest get timeout seconds"""
+        dropped = self.drop(PRIORITY_LOW)
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            dropped += sum(self.drop(priority) for priority in list(self.pending))
+        if dropped:
+            logger.warning("Outbound actions dropped on stop: %s", dropped)
+
+
+outbound = OutboundQueue()
+
+
+def outbound_reply(message, text, priority=PRIORITY_NORMAL, quote=True):
+    """Queues an HTML reply to the message (quote=False just sends it to the message's chat)"""
+    if quote is True:
+        return outbound.submit(message.chat_id, lambda: message.reply_html(text), priority=priority)
+    return outbound.submit(message.chat_id, lambda: message.chat.send_message(text, parse_mode=ParseMode.HTML),
+                           priority=priority)
+
+
+class AdminRoster:
+    """Per-chat administrator ids, fetched in bulk and kept for ttl seconds"""
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.admins = {}
+
+    async def is_admin(self, chat, user_id):
+        entry = self.admins.get(chat.id)
+        if entry is None or entry[0] < time.monotonic():
+            members = await chat.get_administrators()
+            entry = (time.monotonic() + self.ttl, {member.user.id for member in members})
+            self.admins[chat.id] = entry
+        return user_id in entry[1]
+
+    def invalidate(self, chat_id):
+        self.admins.pop(chat_id, None)
+
+    def observe(self, chat_member_update):
+        """Drops the chat's roster when a member update promotes or demotes someone"""
+        if chat_member_update is None:
+            return
+        old_status = chat_member_update.old_chat_member.status
+        new_status = chat_member_update.new_chat_member.status
+        admin_statuses = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+        if old_status != new_status and (old_status in admin_statuses or new_status in admin_statuses):
+            self.invalidate(chat_member_update.chat.id)
+
+
+admin_roster = AdminRoster()
+
+
+class ChatPermissionsCache:
+    """Default member permissions per chat: getChat at most once per ttl seconds,
+    the night mute jobs put what they set right into the cache"""
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.permissions = {}
+
+    async def get(self, bot, chat_id):
+        entry = self.permissions.get(chat_id)
+        if entry is None or entry[0] < time.monotonic():
+            chat = await bot.get_chat(chat_id)
+            entry = self.permissions[chat_id] = (time.monotonic() + self.ttl, chat.permissions)
+        return entry[1]
+
+    def set(self, chat_id, permissions):
+        self.permissions[chat_id] = (time.monotonic() + self.ttl, permissions)
+
+    def set_when_sent(self, future, chat_id, permissions):
+        """Updates the cache once the queued set_chat_permissions call succeeds"""
+        future.add_done_callback(
+            lambda done: done.cancelled() or done.exception() is not None or self.set(chat_id, permissions))
+
+
+chat_permissions = ChatPermissionsCache()
 
 
 async def detect_chat_adm(msg):
     userid = msg.from_user.id
-    member = await msg.chat.get_member(userid)
     anon = None
     if msg.sender_chat is not None:
         anon = msg.sender_chat.id
-    if member.status != 'administrator' and member.status != 'creator' and anon != msg.chat.id:
+    if anon != msg.chat.id and await admin_roster.is_admin(msg.chat, userid) is False:
         return False
     else:
         return True
 
 
+@timed("antispam")
 async def antispam(msg, context):
     """Delete messages from user as channel's sender"""
     if msg.sender_chat is not None:
         if msg.sender_chat.id != msg.chat.id:
             if msg.reply_to_message is None:
-                await context.bot.deleteMessage(msg.chat.id, msg.message_id)
-                return
+                outbound.submit(msg.chat.id, lambda: context.bot.deleteMessage(msg.chat.id, msg.message_id),
+                                priority=PRIORITY_MODERATION, limited=False)
+                return True
             '''if msg.reply_to_message is not None:
                 if msg.reply_to_message.is_automatic_forward is None:
                     if msg.message_thread_id is None:
@@ -382,60 +1190,171 @@ async def antispam(msg, context):
                     for message_entity in message_entities:
                         if message_entity.type == 'url' or message_entity.type == 'text_link':
 
-                            await context.bot.send_message(chat_id=chats[msg.chat.id].support_chat,
-                                                           text=f'URL or text_link, id: {msg.from_user.id}',
-                                                           parse_mode=ParseMode.HTML)
-                            await msg.forward(chats[msg.chat.id].support_chat)
-                            await context.bot.deleteMessage(msg.chat.id, msg.message_id)
+                            support_chat = chats[msg.chat.id].support_chat
+                            outbound.submit(support_chat, lambda: context.bot.send_message(
+                                chat_id=support_chat, text=f'URL or text_link, id: {msg.from_user.id}',
+                                parse_mode=ParseMode.HTML), priority=PRIORITY_MODERATION)
+                            forwarded = outbound.submit(support_chat, lambda: msg.forward(support_chat),
+                                                        priority=PRIORITY_MODERATION)
+                            # Удаляем только после пересылки, параллельно с алертом
+                            outbound.submit(msg.chat.id, lambda: context.bot.deleteMessage(msg.chat.id, msg.message_id),
+                                            priority=PRIORITY_MODERATION, limited=False, after=forwarded)
+                            return True
+    return False
 
 
-async def moderation_alert_sender(update, result_word, context, edited=False):
+async def moderation_alert_sender(update, result_word, context, edited=False, chat=None):
     from_user = update.effective_message.from_user
     caption = update.effective_message.caption
     text = update.effective_message.text
     link = update.effective_message.link
 
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
+    if chat is None:
+        chat = chat_key(update.effective_chat.id)
     user = f"{from_user.first_name}, {from_user.username}, {from_user.id}"
-    await context.bot.send_message(chat_id=chats[chat].support_chat,
-                                   text=f"<b>{user}</b> \n{text if text is not None else caption} \n{link}",
-                                   parse_mode=ParseMode.HTML)
-    if edited is False:
-        await context.bot.send_message(chat_id=chats[chat].support_chat, text=result_word,
-                                       parse_mode=ParseMode.HTML)
-    else:
-        await context.bot.send_message(chat_id=chats[chat].support_chat,
-                                       text=f"{result_word}, сообщение отредактировано",
-                                       parse_mode=ParseMode.HTML)
-
-
-async def moderatorial_user_sender(update, context):
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
+    if edited is True:
+        result_word = f"{result_word}, сообщение отредактировано"
+    # Сообщение и слово-триггер одним алертом
+    return outbound.submit(chats[chat].support_chat, lambda: context.bot.send_message(
+        chat_id=chats[chat].support_chat,
+        text=f"<b>{user}</b> \n{text if text is not None else caption} \n{link}\n{result_word}",
+        parse_mode=ParseMode.HTML), priority=PRIORITY_MODERATION)
+
+
+async def moderatorial_user_sender(update, context, chat=None):
+    if chat is None:
+        chat = chat_key(update.effective_chat.id)
     msg = update.message
     msg_reply = update.message.reply_to_message
-    await context.bot.send_message(chat_id=chats[chat].support_chat,
-                                   text=f'{str(msg_reply.text or "") + str(msg_reply.caption or "")} |{msg.text}| '
-                                        f'{msg_reply.from_user.first_name}, '
-                                        f'{msg_reply.from_user.username}, id: {msg_reply.from_user.id}',
-                                   parse_mode=ParseMode.HTML)
+    outbound.submit(chats[chat].support_chat, lambda: context.bot.send_message(
+        chat_id=chats[chat].support_chat,
+        text=f'{str(msg_reply.text or "") + str(msg_reply.caption or "")} |{msg.text}| '
+             f'{msg_reply.from_user.first_name}, '
+             f'{msg_reply.from_user.username}, id: {msg_reply.from_user.id}',
+        parse_mode=ParseMode.HTML), priority=PRIORITY_MODERATION)
     '''---Добавление пользователя в гугл-таблицу---'''
-    worksheet.append_row([str(datetime.datetime.now(pytz.timezone("Europe/Moscow"))),  # Дата
-                          msg_reply.from_user.id,  # Юзер Айди
-                          msg_reply.from_user.username,  # Юзернейм
-                          msg_reply.from_user.first_name,  # Ник
-                          msg.text,  # Мут/пред/бан
-                          str(msg_reply.text or "") + str(msg_reply.caption or "")])  # Сообщение
+    sheet_log.put([str(datetime.datetime.now(pytz.timezone("Europe/Moscow"))),  # Дата
+                   msg_reply.from_user.id,  # Юзер Айди
+                   msg_reply.from_user.username,  # Юзернейм
+                   msg_reply.from_user.first_name,  # Ник
+                   msg.text,  # Мут/пред/бан
+                   str(msg_reply.text or "") + str(msg_reply.caption or "")])  # Сообщение
     '''----------------------------------------------'''
 
 
+offload_matchers = {}
+
+
+def offload_match(chat, version, words, lists):
+    """Runs in an offload worker: ping, curse and delete matches of each word.
+    Returns None if the worker has not seen this version of the chat's lists and none were sent"""
+    matchers = offload_matchers.get((chat, version))
+    if matchers is None:
+        if lists is None:
+            return None
+        for key in [key for key in offload_matchers if key[0] == chat]:
+            del offload_matchers[key]
+        matchers = offload_matchers[chat, version] = trigger_matchers(*lists)
+    return [{kind: matcher.match(word) for kind, matcher in matchers.items()} for word in words]
+
+
+class ModerationOffload:
+    """Fuzzy matching of long texts in worker processes, so one wall of text does not stall every chat.
+    The bot still decides with find_trigger_word/find_delete_word, the workers only fill in the verdicts"""
+    def __init__(self, min_length=None, workers=2):
+        self.min_length = min_length
+        self.workers = workers
+        self.pool = None
+
+    def wanted(self, text):
+        return self.min_length is not None and len(text) >= self.min_length
+
+    async def fill(self, chat_my, tokens):
+        pending = [token for token in tokens if len(token.matches) < len(chat_my.matchers)]
+        if not pending:
+            return
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        loop = asyncio.get_running_loop()
+        words = [token.word for token in pending]
+        try:
+            matches = await loop.run_in_executor(self.pool, offload_match, chat_my.chat, chat_my.version, words, None)
+            if matches is None:
+                # Воркер еще не видел этих списков - второй заход вместе с ними
+                lists = (chat_my.ping_words, chat_my.curse_words, chat_my.delete_words)
+                matches = await loop.run_in_executor(self.pool, offload_match, chat_my.chat, chat_my.version, words,
+                                                     lists)
+        except (concurrent.futures.process.BrokenProcessPool, OSError) as error:
+            # Проверка пройдет прямо в цикле событий, пул пересоздадим при следующем длинном тексте
+            logger.error("Moderation offload failed: %s", error)
+            self.close()
+            return
+        for token, token_matches in zip(pending, matches):
+            token.matches.update(token_matches)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+offload = ModerationOffload(**(bot_config.moderation_offload or {}))
+
+
+class ModerationPipeline:
+    """Moderation stages over a message normalized once; stops at the first stage that handled it"""
+    def __init__(self, stages):
+        self.stages = stages
+
+    async def run(self, update, context, text, chat=None):
+        if chat is None:
+            chat = chat_key(update.effective_chat.id)
+        tokens = chats[chat].verdicts.tokens(text)
+        if offload.wanted(text):
+            await offload.fill(chats[chat], tokens)
+        for stage in self.stages:
+            if await stage(update, context, chats[chat], tokens) is True:
+                return True
+        return False
+
+
+async def antispam_stage(update, context, chat_my, tokens):
+    """Checks channel comments for spam urls."""
+    if await antispam(update.effective_message, context) is False:
+        return False
+    metrics.count_trigger(chat_my.chat, "antispam")
+    return True
+
+
+async def trigger_words_stage(update, context, chat_my, tokens):
+    """Ping words and curse words, checked word by word in message order."""
+    result_word = find_trigger_word(tokens, chat_my)
+    if result_word is False:
+        return False
+    metrics.count_trigger(chat_my.chat, "trigger")
+    await moderation_alert_sender(update, result_word, context, edited=update.edited_message is not None,
+                                  chat=chat_my.chat)
+    return True
+
+
+async def delete_words_stage(update, context, chat_my, tokens):
+    result_word = find_delete_word(tokens, chat_my)
+    if result_word is False:
+        return False
+    metrics.count_trigger(chat_my.chat, "delete")
+    await moderation_alert_sender(update, result_word, context, edited=False, chat=chat_my.chat)
+    outbound.submit(update.effective_chat.id,
+                    lambda: context.bot.deleteMessage(update.effective_chat.id, update.effective_message.id),
+                    priority=PRIORITY_MODERATION, limited=False)
+    return True
+
+
+moderation_pipeline = ModerationPipeline([antispam_stage, trigger_words_stage, delete_words_stage])
+
+
 async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Tracks the chats the bot is in."""
+    admin_roster.observe(update.my_chat_member)
     result = extract_status_change(update.my_chat_member)
     if result is None:
         return
@@ -482,8 +1401,87 @@ async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await update.effective_message.reply_text(text)
 
 
+class JoinBurstGuard:
+    """Join rate per chat over a sliding window. Past `threshold` joins the chat goes into burst mode
+    and new members are collected for one aggregated greeting; it leaves burst mode at half the threshold"""
+    def __init__(self, window=60, threshold=10):
+        self.window = window
+        self.threshold = threshold
+        self.joins = {}
+        self.burst = set()
+        self.pending = {}
+
+    def register(self, chat_id):
+        """Counts a join, returns True while the chat is in burst mode"""
+        now = time.monotonic()
+        joins = self.joins.setdefault(chat_id, collections.deque())
+        joins.append(now)
+        while joins[0] <= now - self.window:
+            joins.popleft()
+        if len(joins) > self.threshold:
+            self.burst.add(chat_id)
+        elif len(joins) <= self.threshold // 2:
+            self.burst.discard(chat_id)
+        return chat_id in self.burst
+
+    def add(self, chat_id, user):
+        """Collects a member for the aggregated greeting, True for the first one (time to schedule the flush)"""
+        members = self.pending.setdefault(chat_id, [])
+        members.append(user)
+        return len(members) == 1
+
+    def take(self, chat_id):
+        return self.pending.pop(chat_id, [])
+
+
+join_guard = JoinBurstGuard()
+RAID_FLUSH_DELAY = 30
+RAID_RESTRICT_HOURS = 24
+RAID_GREET_NAMES = 30
+
+
+def text_chunks(lines, limit=4000):
+    """Joins lines into messages no longer than Telegram allows"""
+    chunk = ""
+    for line in lines:
+        if chunk and len(chunk) + len(line) + 1 > limit:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        yield chunk
+
+
+async def raid_flush(context: ContextTypes.DEFAULT_TYPE):
+    """One greeting and one join report for all members collected in burst mode"""
+    job = context.job
+    chat_id = job.data
+    members = join_guard.take(job.chat_id)
+    if not members:
+        return
+    if chats[chat_id].admin_commands['notify_join']['state'] is True:
+        lines = [f"‼<b>{len(members)} joined in burst mode</b>‼"]
+        lines += [f"{member.first_name}, {member.username}, {member.id}" for member in members]
+        for text in text_chunks(lines):
+            outbound.submit(chats[chat_id].support_chat, lambda text=text: context.bot.send_message(
+                chat_id=chats[chat_id].support_chat, text=text, parse_mode=ParseMode.HTML))
+    if chats[chat_id].admin_commands['hello']['state'] is True:
+        member_name = ", ".join(member.mention_html() for member in members[:RAID_GREET_NAMES])
+        if len(members) > RAID_GREET_NAMES:
+            member_name = f"{member_name} и еще {len(members) - RAID_GREET_NAMES}"
+        if chats[chat_id].admin_commands['spoilers']['state'] is False:
+            hello = chats[chat_id].hello.format(member_name=member_name)
+        else:
+            hello = chats[chat_id].hello_spoil.format(member_name=member_name)
+        outbound.submit(job.chat_id, lambda: context.bot.send_message(chat_id=job.chat_id, text=hello,
+                                                                      parse_mode=ParseMode.HTML),
+                        priority=PRIORITY_LOW)
+
+
+@timed("greet")
 async def greet_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Greets new users in chats and announces when someone leaves"""
+    admin_roster.observe(update.chat_member)
     result = extract_status_change(update.chat_member)
     if result is None:
         return
@@ -491,70 +1489,220 @@ async def greet_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
     was_member, is_member = result
     cause_name = update.chat_member.from_user.mention_html()
     member_name = update.chat_member.new_chat_member.user.mention_html()
-    chat = await context.bot.getChat(update.effective_chat.id)
-    if chat.permissions is None:
+    chat = update.effective_chat
+    permissions = await chat_permissions.get(context.bot, chat.id)
+    if permissions is None:
         return
 
-    if chats.get(chat.id) is not None:
-        chat_id = chat.id
-    else:
-        chat_id = support_chats[chat.id]
+    chat_id = chat_key(chat.id)
 
     if not was_member and is_member:
-        if chat.permissions.can_send_messages:
+        if permissions.can_send_messages:
+            if join_guard.register(chat.id) is True:
+                new_member = update.chat_member.new_chat_member.user
+                if chats[chat_id].admin_commands.get('raid_restrict', {}).get('state') is True:
+                    until_date = time.time() + RAID_RESTRICT_HOURS * 3600
+                    outbound.submit(chat.id, lambda: context.bot.restrict_chat_member(
+                        chat.id, new_member.id, ChatPermissions(can_send_messages=False), until_date),
+                        priority=PRIORITY_MODERATION, limited=False)
+                if join_guard.add(chat.id, new_member) is True:
+                    context.job_queue.run_once(raid_flush, RAID_FLUSH_DELAY, data=chat_id, chat_id=chat.id,
+                                               name=f"raid_{chat.id}")
+                return
             if chats[chat_id].admin_commands['notify_join']['state'] is True:
                 user = f"{update.chat_member.new_chat_member.user.first_name}, " \
                        f"{update.chat_member.new_chat_member.user.username}, " \
                        f"{update.chat_member.new_chat_member.user.id}"
                 text = "now joined."
-                await context.bot.send_message(chat_id=chats[chat_id].support_chat, text=f"‼<b>{user}</b> \n{text}‼",
-                                               parse_mode=ParseMode.HTML)
+                outbound.submit(chats[chat_id].support_chat, lambda: context.bot.send_message(
+                    chat_id=chats[chat_id].support_chat, text=f"‼<b>{user}</b> \n{text}‼", parse_mode=ParseMode.HTML))
             if chats[chat_id].admin_commands['hello']['state'] is True:
                 if chats[chat_id].admin_commands['spoilers']['state'] is False:
-                    await update.effective_chat.send_message(
-                        chats[chat_id].hello.format(member_name=member_name),
-                        parse_mode=ParseMode.HTML,
-                    )
+                    hello = chats[chat_id].hello.format(member_name=member_name)
                 else:
-                    await update.effective_chat.send_message(
-                        chats[chat_id].hello_spoil.format(member_name=member_name),
-                        parse_mode=ParseMode.HTML,
-                    )
+                    hello = chats[chat_id].hello_spoil.format(member_name=member_name)
+                outbound.submit(chat.id, lambda: update.effective_chat.send_message(
+                    hello,
+                    parse_mode=ParseMode.HTML,
+                ), priority=PRIORITY_LOW)
     elif was_member and not is_member:
         if chats[chat_id].admin_commands['goodbye']['state'] is True:
-            await update.effective_chat.send_message(
-                f"{random.choice(chats[chat_id].goodbye)}",
+            goodbye = random.choice(chats[chat_id].goodbye)
+            outbound.submit(chat.id, lambda: update.effective_chat.send_message(
+                f"{goodbye}",
                 parse_mode=ParseMode.HTML,
-            )
+            ), priority=PRIORITY_LOW)
+
+
+class Blocklist:
+    """Users whose private messages are not forwarded. A set in memory, an append-only log on disk:
+    "add <id> <expires>" and "remove <id>" lines, expires is a unix time or 0 for never"""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+    def load(self, legacy=()):
+        """Replays the log; the first run imports the old private_spammers list from config.json"""
+        lines = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as logf:
+                for line in logf:
+                    fields = line.split()
+                    lines += 1
+                    if len(fields) == 3 and fields[0] == "add":
+                        self.entries[int(fields[1])] = float(fields[2]) or None
+                    elif len(fields) == 2 and fields[0] == "remove":
+                        self.entries.pop(int(fields[1]), None)
+        except FileNotFoundError:
+            self.add_many(legacy)
+            return
+        self.entries = {user_id: expires for user_id, expires in self.entries.items()
+                        if expires is None or expires > time.time()}
+        if lines > 2 * len(self.entries) + 100:
+            self.compact()
+
+    def compact(self):
+        """Rewrites the log with only the current entries"""
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(self.path) or '.',
+                                         suffix='.tmp', delete=False) as tmp:
+            tmp.writelines(f"add {user_id} {expires or 0}\n" for user_id, expires in self.entries.items())
+        os.replace(tmp.name, self.path)
+
+    def append(self, lines):
+        with open(self.path, 'a', encoding='utf-8') as logf:
+            logf.writelines(lines)
+
+    def __contains__(self, user_id):
+        expires = self.entries.get(user_id, 0)
+        if expires is None:
+            return True
+        if expires == 0:
+            return False
+        if expires > time.time():
+            return True
+        del self.entries[user_id]
+        return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_many(self, user_ids, days=None):
+        """Adds the users (for days, or forever), returns how many were new"""
+        expires = time.time() + days * 86400 if days else None
+        added = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in self]
+        for user_id in added:
+            self.entries[user_id] = expires
+        self.append(f"add {user_id} {expires or 0}\n" for user_id in added)
+        return len(added)
+
+    def remove(self, user_id):
+        if user_id in self.entries:
+            del self.entries[user_id]
+            self.append([f"remove {user_id}\n"])
+
+    def export(self):
+        return [user_id for user_id in list(self.entries) if user_id in self]
+
+
+blocklist = Blocklist(bot_config.blocklist_file)
+PM_MERGE_WINDOW = 60
+
+
+class PrivateForwards:
+    """Private messages forwarded to the owner: a user's first message goes right away,
+    the rest of the window go together in one forward"""
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, user_id, message_id):
+        """True if the user's window has just opened"""
+        if user_id in self.pending:
+            self.pending[user_id].append(message_id)
+            return False
+        self.pending[user_id] = []
+        return True
+
+    def take(self, user_id):
+        return self.pending.pop(user_id, [])
+
+
+private_forwards = PrivateForwards()
+
+
+async def private_forwards_flush(context: ContextTypes.DEFAULT_TYPE):
+    """Forwards what the user sent during the window, up to 100 messages per call"""
+    user_id, user = context.job.data
+    # forwardMessages принимает только строго возрастающие id
+    message_ids = sorted(set(private_forwards.take(user_id)))
+    forward_pm = int(bot_config.forward_pm)
+    if not message_ids:
+        return
+    outbound.submit(forward_pm, lambda: context.bot.send_message(
+        forward_pm, f"{user}\nЕщё сообщений: {len(message_ids)}"))
+    for start in range(0, len(message_ids), 100):
+        batch = message_ids[start:start + 100]
+        outbound.submit(forward_pm, lambda batch=batch: context.bot.forward_messages(forward_pm, user_id, batch))
+
+
+async def blocklist_commands(update, context, command, args):
+    """Owner commands: Ignore <id> [days], Unignore <id>, Ignore_import <ids or a file>, Ignore_export"""
+    message = update.effective_message
+    forward_pm = int(bot_config.forward_pm)
+    if command == "Ignore" and args:
+        spammer = int(args[0])
+        if spammer != forward_pm:
+            blocklist.add_many([spammer], days=float(args[1]) if len(args) > 1 else None)
+    elif command == "Unignore" and args:
+        blocklist.remove(int(args[0]))
+    elif command == "Ignore_import":
+        text = ' '.join(args)
+        if message.document is not None:
+            document = await message.document.get_file()
+            text = (await document.download_as_bytearray()).decode('utf-8', 'replace')
+        user_ids = [int(user_id) for user_id in re.findall(r'-?\d+', text) if int(user_id) != forward_pm]
+        added = blocklist.add_many(user_ids)
+        outbound_reply(message, f"Добавлено: {added}, всего в списке: {len(blocklist)}")
+    elif command == "Ignore_export":
+        user_ids = '\n'.join(str(user_id) for user_id in blocklist.export())
+        outbound.submit(forward_pm, lambda: context.bot.send_document(
+            forward_pm, user_ids.encode(), filename="private_spammers.txt"))
 
 
 async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Forward the private user message."""
     user = update.effective_user
-    message = update.effective_message.text.split()
-    if user.id == int(bot_config.forward_pm) and message[0] == "Ignore":
-        spammer = int(message[1])
-        if user.id != spammer and spammer not in bot_config.private_spammers:
-            bot_config.private_spammers.append(spammer)
-            bot_config_writer(bot_config)
-    if user.id not in bot_config.private_spammers:
-        await context.bot.send_message(bot_config.forward_pm, user)
-        await update.message.forward(bot_config.forward_pm)
+    message = update.effective_message
+    words = (message.text or message.caption or "").split()
+    forward_pm = int(bot_config.forward_pm)
+    if user.id == forward_pm and words and words[0] in ("Ignore", "Unignore", "Ignore_import", "Ignore_export"):
+        await blocklist_commands(update, context, words[0], words[1:])
+        return
+    # Правки уже пересланных сообщений не пересылаем: в пачке они дали бы повторные id
+    if user.id in blocklist or update.message is None:
+        return
+    if private_forwards.add(user.id, message.message_id) is False:
+        return
+    outbound.submit(forward_pm, lambda: context.bot.send_message(forward_pm, user))
+    outbound.submit(forward_pm, lambda: message.forward(forward_pm))
+    context.job_queue.run_once(private_forwards_flush, PM_MERGE_WINDOW, data=(user.id, str(user)),
+                               name=f"pm_{user.id}")
 
 
 async def forward_vip(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Forward from channel to private chat."""
     if update.channel_post.pinned_message is None:
-        await update.channel_post.forward(bot_config.private_chat)
+        outbound.submit(bot_config.private_chat, lambda: update.channel_post.forward(bot_config.private_chat))
 
 
-async def new_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def new_post(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
     """Announce new web post"""
     text = update.message.text.split()
-    pin_msg = await context.bot.send_message(chat_id=bot_config.private_chat,
-                                             text=f"На Бусти новый пост! Уровень подписки {text[-1]} и выше! {text[1]}"
-                                             )
-    await context.bot.pin_chat_message(pin_msg.chat.id, pin_msg.message_id)
+    pin_msg = await outbound.submit(bot_config.private_chat, lambda: context.bot.send_message(
+        chat_id=bot_config.private_chat,
+        text=f"На Бусти новый пост! Уровень подписки {text[-1]} и выше! {text[1]}"
+    ))
+    outbound.submit(pin_msg.chat.id, lambda: context.bot.pin_chat_message(pin_msg.chat.id, pin_msg.message_id),
+                    limited=False)
 
 
 # Define a few command handlers. These usually take the two arguments update and
@@ -562,28 +1710,22 @@ async def new_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     # user = update.effective_user
-    await update.message.reply_html(
-        "Привет!",
-        # reply_markup=ForceReply(selective=True),
-    )
+    outbound_reply(update.message, "Привет!")
 
 
 async def delete_join(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Delete chat join messages"""
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
+    chat = chat_key(update.effective_chat.id)
     if chats[chat].admin_commands['delete_join']['state'] is True:
-        await update.message.delete()
+        outbound.submit(update.effective_chat.id, lambda: update.message.delete(), limited=False)
 
 
-async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
     if await detect_chat_adm(update.message):
-        await moderatorial_user_sender(update, context)
+        await moderatorial_user_sender(update, context, chat)
 
 
-async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
     if await detect_chat_adm(update.message) is True:
         msg = update.message
         mute_time = 24
@@ -591,202 +1733,238 @@ async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             mute_time = int(update.message.text.split()[-1])
         member_id = update.message.reply_to_message.from_user.id
         chat_permissions = ChatPermissions(can_send_messages=False)
-        await context.bot.restrict_chat_member(msg.chat.id, member_id, chat_permissions,
-                                               time.time() + mute_time * 3600)
-        await moderatorial_user_sender(update, context)
+        until_date = time.time() + mute_time * 3600
+        outbound.submit(msg.chat.id, lambda: context.bot.restrict_chat_member(msg.chat.id, member_id, chat_permissions,
+                                                                              until_date),
+                        priority=PRIORITY_MODERATION, limited=False)
+        await moderatorial_user_sender(update, context, chat)
 
 
-async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
     if await detect_chat_adm(update.message) is True:
         msg = update.message
         member_id = update.message.reply_to_message.from_user.id
-        await context.bot.banChatMember(chat_id=msg.chat_id, user_id=member_id)
-        await moderatorial_user_sender(update, context)
+        outbound.submit(msg.chat_id, lambda: context.bot.banChatMember(chat_id=msg.chat_id, user_id=member_id),
+                        priority=PRIORITY_MODERATION, limited=False)
+        await moderatorial_user_sender(update, context, chat)
 
 
-async def moderation_msg(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@timed("moderation_msg")
+async def moderation_msg(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
     """Copy all massages from anon admin"""
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
+    if chat is None:
+        chat = chat_key(update.effective_chat.id)
     if chats[chat].admin_commands['q&a']['state'] is True:
         if update.message.sender_chat is not None:
             anon = update.message.sender_chat.id
             if anon == update.message.chat.id:
-                await update.message.copy(chats[chat].support_chat)
+                outbound.submit(chats[chat].support_chat, lambda: update.message.copy(chats[chat].support_chat))
 
     """Role-play commands"""
     if update.message is not None and update.message.reply_to_message is not None:
-        user_command = [word for word in update.message.text.split()]
-        for action in chats[chat].rp_actions:
-            if user_command[0].lower() == action:
-                await context.bot.send_message(chat_id=update.message.chat.id,
-                                               text=f"{chats[chat].rp_actions[action]} "
-                                                    f"{update.message.reply_to_message.from_user.mention_html()} "
-                                                    f"{' '.join(user_command[1:])}",
-                                               parse_mode=ParseMode.HTML)
+        words = update.message.text.split()
+        found = chats[chat].rp_index.find(words)
+        if found is not None and chats[chat].rp_index.allow(update.message.from_user.id):
+            template, size = found
+            rp_text = template.render({'actor': update.message.from_user.mention_html(),
+                                       'target': update.message.reply_to_message.from_user.mention_html(),
+                                       'rest': ' '.join(words[size:])})
+            outbound.submit(update.message.chat.id, lambda: context.bot.send_message(
+                chat_id=update.message.chat.id, text=rp_text, parse_mode=ParseMode.HTML), priority=PRIORITY_LOW)
 
-    """Checks channel comments for spam urls."""
-    await antispam(update.effective_message, context)
+    """Checks chat messages for spam and unacceptable content."""
+    await moderation_pipeline.run(update, context, update.effective_message.text, chat)
 
-    """Checks chat messages for unacceptable content."""
-    result_word = filter_word(update.effective_message.text, update.effective_chat.id)
-    if result_word is not False:
-        if update.edited_message is None:
-            await moderation_alert_sender(update, result_word, context, edited=False)
-        else:
-            await moderation_alert_sender(update, result_word, context, edited=True)
-    else:
-        result_word = delete_word(update.effective_message.text, update.effective_chat.id)
-        if result_word is not False:
-            await moderation_alert_sender(update, result_word, context, edited=False)
-            await context.bot.deleteMessage(update.effective_chat.id, update.effective_message.id)
 
+@timed("moderation_caption")
+async def moderation_caption(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
+    """Checks chat messages for spam and unacceptable content."""
+    await moderation_pipeline.run(update, context, update.effective_message.caption, chat)
 
-async def moderation_caption(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Checks channel comments for spam urls."""
-    await antispam(update.effective_message, context)
 
-    """Checks chat messages for unacceptable content."""
-    result_word = filter_word(update.effective_message.caption, update.effective_chat.id)
-    if result_word is not False:
-        if update.edited_message is None:
-            await moderation_alert_sender(update, result_word, context, edited=False)
-        else:
-            await moderation_alert_sender(update, result_word, context, edited=True)
-    else:
-        result_word = delete_word(update.effective_message.caption, update.effective_chat.id)
-        if result_word is not False:
-            await moderation_alert_sender(update, result_word, context, edited=False)
-            await context.bot.deleteMessage(update.effective_chat.id, update.effective_message.id)
+async def random_fun(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
+    """Bot replies a random string from text file"""
+    if chat is None:
+        chat = chat_key(update.effective_chat.id)
+    outbound_reply(update.message, random.choice(chats[chat].ping_rand), priority=PRIORITY_LOW)
 
 
-async def random_fun(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Bot replies a random string from text file"""
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
-    await update.message.reply_html(random.choice(chats[chat].ping_rand))
+RANDOM_GAME_MAX_COUNT = 100
+RANDOM_GAME_MAX_IGNORE = 1000
+RANDOM_GAME_MAX_NUMBER = 10 ** 12
 
 
-async def random_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def sample_excluding(count, low, high, excluded):
+    """count distinct random numbers from low..high except the sorted excluded ones (all inside the range),
+    without building the range: indexes of the allowed numbers are sampled and shifted past the exclusions"""
+    shifts = [number - position for position, number in enumerate(excluded)]
+    indexes = random.sample(range(high - low + 1 - len(excluded)), count)
+    return [low + index + bisect.bisect_right(shifts, low + index) for index in indexes]
+
+
+async def random_game(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
     """Bot replies a random number"""
-    global ignore
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
+    if chat is None:
+        chat = chat_key(update.effective_chat.id)
     if update.message is not None:
         if await detect_chat_adm(update.message):
             s = update.message.text
-            nums = re.findall(r'\d+', s)
-            nums = [int(i) for i in nums]
-            diap = list(range(nums[1], nums[2] + 1))
-            if update.effective_chat.id == chats[chat].support_chat:
-                ignore = nums[3:]  # In admin chat, you can edit numbers to ignore
+            # Слишком длинные числа не переводим в int, проверки ниже их все равно отклонят
+            nums = [int(i) if len(i) <= 13 else RANDOM_GAME_MAX_NUMBER + 1 for i in re.findall(r'\d+', s)]
+            if len(nums) < 3:
+                outbound_reply(update.message, "Нужно три числа: сколько выбрать, начало и конец диапазона.")
+                return
+            count, low, high = nums[:3]
+            ignore_lists = context.bot_data.get("random_game_ignore")
+            if not isinstance(ignore_lists, dict):
+                ignore_lists = context.bot_data["random_game_ignore"] = {}
+            admin_chat = update.effective_chat.id == chats[chat].support_chat
+            # In admin chat, you can edit numbers to ignore; the list is saved only if it passes the checks below
+            ignore = sorted(set(nums[3:] if admin_chat else ignore_lists.get(chat, [])))
             print(ignore)
-            for del_num in ignore:
-                if del_num in diap:
-                    diap.remove(del_num)
-                else:
-                    await update.message.reply_html(
-                        f"Числа-исключения вне диапазона.")
-                    return
-            rand_nums = []
-            if nums[0] > len(diap):
-                if update.effective_chat.id == chats[chat].support_chat:
-                    await update.message.reply_html(
-                        f"Количество чисел больше диапазона.")
+            if low > high or high > RANDOM_GAME_MAX_NUMBER:
+                outbound_reply(update.message, f"Диапазон должен быть от меньшего к большему, "
+                                               f"не больше {RANDOM_GAME_MAX_NUMBER}.")
+                return
+            if count > RANDOM_GAME_MAX_COUNT or len(ignore) > RANDOM_GAME_MAX_IGNORE:
+                outbound_reply(update.message, f"Не больше {RANDOM_GAME_MAX_COUNT} чисел "
+                                               f"и {RANDOM_GAME_MAX_IGNORE} исключений.")
+                return
+            if ignore and (ignore[0] < low or ignore[-1] > high):
+                outbound_reply(update.message, f"Числа-исключения вне диапазона.")
+                return
+            if count > high - low + 1 - len(ignore):
+                if admin_chat:
+                    outbound_reply(update.message, f"Количество чисел больше диапазона.")
             else:
-                for i in range(nums[0]):
-                    rand_num = random.choice(range(len(diap)))
-                    rand_nums.append(diap[rand_num])
-                    del diap[rand_num]
-                await update.message.reply_html(
-                    f"Случайные числа: {rand_nums}.")
+                if admin_chat:
+                    ignore_lists[chat] = nums[3:]
+                rand_nums = sample_excluding(count, low, high, ignore)
+                outbound_reply(update.message, f"Случайные числа: {rand_nums}.")
 
 
-async def adm_chat_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def adm_chat_commands(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
     """Bot control settings"""
     global bot_config
     msg = update.message
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
+    if chat is None:
+        chat = chat_key(update.effective_chat.id)
     if await detect_chat_adm(msg) is True:
         admin_message = msg.text
         if admin_message == f"{bot_config.admin_command_start}{bot_config.admin_command_update}":
+            await config_writer.flush()
             bot_config = bot_config_load()
-            chats[chat] = chat_content_load(chat)
+            chats.reload(chat)
             current_jobs = context.job_queue.get_jobs_by_name(str(chat))
             if chats[chat].admin_commands['night_mute']['state'] is True and not current_jobs:
                 mute_jobs(context.job_queue, chat)
-                await update.message.reply_html('Jobs created')
+                outbound_reply(update.message, 'Jobs created')
                 return
             elif chats[chat].admin_commands['night_mute']['state'] is False and current_jobs:
                 for job in current_jobs:
                     job.enabled = False
                     job.schedule_removal()
-                    await update.message.reply_html('Job destroyed')
+                    outbound_reply(update.message, 'Job destroyed')
                     return
             print(current_jobs)
-            await update.message.reply_html(
-                'Ok')
+            outbound_reply(update.message, 'Ok')
+            return
+        if admin_message == f"{bot_config.admin_command_start}{bot_config.admin_command_cancel}":
+            cancelled = helper_delayed_cancel(context.job_queue, chat)
+            outbound_reply(update.message, f'Отложенных ответов отменено: {cancelled}')
             return
         for command in chats[chat].admin_commands:
             if admin_message == bot_config.admin_command_start:
                 command_list = ""
                 for commands in chats[chat].admin_commands:
                     command_list = command_list + f"{commands}: {str(chats[chat].admin_commands[commands]['state'])} \n"
-                await update.message.reply_html(command_list)
+                outbound_reply(update.message, command_list)
                 return
             if admin_message == f"{bot_config.admin_command_start}{command}_off" and \
                     chats[chat].admin_commands[command]['state'] is True:
-                await update.effective_chat.send_message(
-                    chats[chat].admin_commands[command]['answer_off'],
-                    parse_mode=ParseMode.HTML,
-                )
+                outbound_reply(update.message, chats[chat].admin_commands[command]['answer_off'], quote=False)
                 chats[chat].admin_commands[command]['state'] = False
                 chat_config_writer({'support_chat': chats[chat].support_chat,
                                     'admin_commands': chats[chat].admin_commands}, chat)
                 return
             elif admin_message == f"{bot_config.admin_command_start}{command}_on" and \
                     chats[chat].admin_commands[command]['state'] is False:
-                await update.effective_chat.send_message(
-                    chats[chat].admin_commands[command]['answer_on'],
-                    parse_mode=ParseMode.HTML,
-                )
+                outbound_reply(update.message, chats[chat].admin_commands[command]['answer_on'], quote=False)
                 chats[chat].admin_commands[command]['state'] = True
                 chat_config_writer({'support_chat': chats[chat].support_chat,
                                     'admin_commands': chats[chat].admin_commands}, chat)
                 return
     else:
-        await update.message.reply_html(bot_config.non_admin_answer)
+        outbound_reply(update.message, bot_config.non_admin_answer)
 
 
-async def helper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if chats.get(update.effective_chat.id) is not None:
-        chat = update.effective_chat.id
-    else:
-        chat = support_chats[update.effective_chat.id]
+HELPER_DELAY = 10
+
+
+def helper_delay(helper_entity):
+    """Seconds before the helper content is sent: 'Yes' means the default delay, a number sets its own"""
+    delay = helper_entity.get('delay')
+    if delay == 'Yes':
+        return HELPER_DELAY
+    try:
+        return max(float(delay), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+async def helper_delayed_reply(context: ContextTypes.DEFAULT_TYPE):
+    job = context.job
+    outbound.submit(job.data['chat_id'], lambda: context.bot.send_message(
+        chat_id=job.data['chat_id'], text=job.data['content'], parse_mode=ParseMode.HTML,
+        reply_to_message_id=job.data['message_id']))
+
+
+def helper_delayed_cancel(job_queue, chat):
+    """Removes the chat's pending delayed helper replies, returns how many were pending"""
+    jobs = job_queue.get_jobs_by_name(f"helper_{chat}")
+    for job in jobs:
+        job.schedule_removal()
+    return len(jobs)
+
+
+def helper_find(chat_my, text):
+    """(helper entry, exact) for the message: exact command or alias first, then the longest multi-word
+    command prefix; exact is False when the message has words after the command"""
+    keyword = replace_letters(text)
+    helper_entity = chat_my.helper_index.get(keyword)
+    if helper_entity is not None:
+        return helper_entity, True
+    words = keyword.split()
+    for size in range(min(len(words) - 1, chat_my.helper_prefix_words), 1, -1):
+        helper_entity = chat_my.helper_prefixes.get(' '.join(words[:size]))
+        if helper_entity is not None:
+            return helper_entity, False
+    return None, False
+
+
+@timed("helper")
+async def helper(update: Update, context: ContextTypes.DEFAULT_TYPE, chat=None) -> None:
+    if chat is None:
+        chat = chat_key(update.effective_chat.id)
     try:
         if update.message is not None:
-            for helper_entity in chats[chat].helper:
-                keyword = replace_letters(update.message.text)
-                if helper_entity['command'] == keyword:
-                    if helper_entity['delay'] == 'Yes':
-                        await update.message.reply_html(
-                            f"{random.choice(chats[chat].rand_pervoe)}")
-                        time.sleep(10)
-                    await update.message.reply_html(
-                        helper_entity['content'],
-                        # reply_markup=ForceReply(selective=True),
-                    )
+            helper_entity, exact = helper_find(chats[chat], update.message.text)
+            # Слова после команды проверяются модерацией как обычное сообщение, ответ только если она не сработала
+            if helper_entity is not None and not exact and \
+                    await moderation_pipeline.run(update, context, update.message.text, chat) is True:
+                return
+            if helper_entity is not None:
+                delay = helper_delay(helper_entity)
+                if delay > 0:
+                    outbound_reply(update.message, f"{random.choice(chats[chat].rand_pervoe)}")
+                    context.job_queue.run_once(helper_delayed_reply, delay, name=f"helper_{chat}",
+                                               data={'chat_id': update.effective_chat.id,
+                                                     'message_id': update.message.message_id,
+                                                     'content': helper_entity['content']})
                     return
-            await moderation_msg(update, context)
+                outbound_reply(update.message, helper_entity['content'])
+                return
+            await moderation_msg(update, context, chat)
     except AttributeError:
         print(AttributeError.args)
         print(update)
@@ -794,28 +1972,34 @@ async def helper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def chat_mute(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
-    await context.bot.set_chat_permissions(chat_id=job.chat_id, permissions=ChatPermissions(can_send_messages=False))
+    permissions = ChatPermissions(can_send_messages=False)
+    chat_permissions.set_when_sent(outbound.submit(job.chat_id, lambda: context.bot.set_chat_permissions(
+        chat_id=job.chat_id, permissions=permissions), limited=False), job.chat_id, permissions)
     if chats[job.chat_id].admin_commands['hello']['state'] is True:
         chats[job.chat_id].admin_commands['hello']['state'] = False
     if chats[job.chat_id].admin_commands['goodbye']['state'] is True:
         chats[job.chat_id].admin_commands['goodbye']['state'] = False
-    await context.bot.send_message(chat_id=job.chat_id, text='Комментарии закрываются! Спокойной ночи. ✨')
+    outbound.submit(job.chat_id, lambda: context.bot.send_message(chat_id=job.chat_id,
+                                                                  text='Комментарии закрываются! Спокойной ночи. ✨'))
 
 
 async def chat_unmute(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
-    await context.bot.set_chat_permissions(chat_id=job.chat_id, permissions=ChatPermissions(can_send_messages=True,
-                                                                                            can_send_audios=True,
-                                                                                            can_send_videos=True,
-                                                                                            can_send_documents=True,
-                                                                                            can_send_polls=True,
-                                                                                            can_send_video_notes=True,
-                                                                                            can_send_voice_notes=True,
-                                                                                            can_send_other_messages=True,
-                                                                                            can_add_web_page_previews=True,
-                                                                                            can_send_photos=True))
-
-    await context.bot.send_message(chat_id=job.chat_id, text='Комментарии открыты! Доброе утро. 🌼')
+    permissions = ChatPermissions(can_send_messages=True,
+                                  can_send_audios=True,
+                                  can_send_videos=True,
+                                  can_send_documents=True,
+                                  can_send_polls=True,
+                                  can_send_video_notes=True,
+                                  can_send_voice_notes=True,
+                                  can_send_other_messages=True,
+                                  can_add_web_page_previews=True,
+                                  can_send_photos=True)
+    chat_permissions.set_when_sent(outbound.submit(job.chat_id, lambda: context.bot.set_chat_permissions(
+        chat_id=job.chat_id, permissions=permissions), limited=False), job.chat_id, permissions)
+
+    outbound.submit(job.chat_id, lambda: context.bot.send_message(chat_id=job.chat_id,
+                                                                  text='Комментарии открыты! Доброе утро. 🌼'))
 
 
 def mute_jobs(job_queue, chat):
@@ -825,21 +2009,302 @@ def mute_jobs(job_queue, chat):
                         chat_id=chat, name=str(chat))
 
 
-def main() -> None:
-    """Start the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token(bot_config.telegram_token).build()
+async def on_startup(application: Application) -> None:
+    """Load the chats and schedule their jobs; the sheet connects in the background."""
+    chats.discover()
+    blocklist.load(bot_config.private_spammers)
 
     # Chats night mute scheduler
     job_queue = application.job_queue
     for chat in chats:
-        print(chats[chat].admin_commands['night_mute']['state'])
-        if chats[chat].admin_commands['night_mute']['state'] is True:
+        night_mute = chat_config_read(chat)['admin_commands']['night_mute']['state']
+        print(night_mute)
+        if night_mute is True:
             mute_jobs(job_queue, chat)
         print(job_queue.get_jobs_by_name(str(chat)))
     for job in job_queue.jobs():
         print(job.chat_id, job.name)
 
+    background_tasks.add(asyncio.create_task(sheet_log_connect()))
+    background_tasks.add(asyncio.create_task(loop_lag_monitor()))
+    if bot_config.metrics:
+        metrics.server = await asyncio.start_server(metrics_serve, bot_config.metrics.get('listen', '127.0.0.1'),
+                                                    bot_config.metrics.get('port', 9100))
+
+
+async def on_stop(application: Application) -> None:
+    """Send the queued outbound actions while the bot can still talk to Telegram."""
+    await outbound.stop(OUTBOUND_STOP_TIMEOUT)
+
+
+async def on_shutdown(application: Application) -> None:
+    """Flush pending background writes before the process exits."""
+    for task in background_tasks:
+        task.cancel()
+    if metrics.server is not None:
+        metrics.server.close()
+    offload.close()
+    await config_writer.flush()
+    await asyncio.to_thread(sheet_log.close)
+
+
+async def first_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reports the time from process start to the first update."""
+    global first_update_time
+    if first_update_time is None:
+        first_update_time = time.monotonic() - process_started
+        print(f"Time to first update: {first_update_time:.3f} s")
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Updates of different chats are processed concurrently, updates of one chat strictly in arrival order"""
+    def __init__(self, max_concurrent_updates):
+        # Слот базового семафора занимают и апдейты, ждущие свой чат: с любым пределом очередь одного чата
+        # заняла бы все слоты и остановила остальные чаты. Поэтому он без предела (и больше 1, иначе PTB
+        # обрабатывает апдейты по одному), а настоящий предел - self.running, его берем после блокировки чата
+        super().__init__(sys.maxsize)
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.locks = {}
+        self.waiting = collections.Counter()
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self.running:
+                await coroutine
+            return
+        lock = self.locks.setdefault(chat.id, asyncio.Lock())
+        self.waiting[chat.id] += 1
+        try:
+            async with lock, self.running:
+                await coroutine
+        finally:
+            self.waiting[chat.id] -= 1
+            if self.waiting[chat.id] == 0:
+                del self.waiting[chat.id]
+                del self.locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class SqlitePersistence(BasePersistence):
+    """bot_data, chat_data, user_data and conversations in one SQLite table, a pickled row per key.
+    Sets and dicts in bot_data (user ids, random game exclusions) get a row per member or item,
+    so adding one user writes one row instead of the whole set. Rows are written only when changed."""
+    def __init__(self, path, update_interval=30):
+        # Состояние бота живет в bot_data, пустые chat_data каждого чата хранить незачем
+        super().__init__(PersistenceInput(chat_data=False, user_data=False, callback_data=False), update_interval)
+        self.path = path
+        self.connection = None
+        self.written = {}
+        self.members = {}  # kind -> члены множества или элементы словаря, как записаны в базе
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS state "
+                                    "(kind TEXT, key TEXT, value BLOB, PRIMARY KEY (kind, key))")
+        return self.connection
+
+    def load(self, kind):
+        """Stored (key, value) pairs of the kind, remembering what is on disk"""
+        rows = self.connect().execute("SELECT key, value FROM state WHERE kind = ?", (kind,)).fetchall()
+        for key, value in rows:
+            self.written[kind, key] = value
+        return [pickle.loads(value) for key, value in rows]
+
+    def store(self, kind, items, replace=False):
+        """Writes the changed items {key: value}; replace=True also deletes the kind's keys missing from items"""
+        connection = self.connect()
+        changed = []
+        for key, value in items.items():
+            blob = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+            if self.written.get((kind, repr(key))) != blob:
+                changed.append((kind, repr(key), blob))
+        removed = []
+        if replace:
+            keys = {repr(key) for key in items}
+            removed = [written for written in self.written if written[0] == kind and written[1] not in keys]
+        if not changed and not removed:
+            return
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO state (kind, key, value) VALUES (?, ?, ?)", changed)
+            connection.executemany("DELETE FROM state WHERE kind = ? AND key = ?", removed)
+        for kind_key_blob in changed:
+            self.written[kind_key_blob[:2]] = kind_key_blob[2]
+        for written in removed:
+            del self.written[written]
+
+    def drop(self, kind, key):
+        with self.connect():
+            self.connection.execute("DELETE FROM state WHERE kind = ? AND key = ?", (kind, repr(key)))
+        self.written.pop((kind, repr(key)), None)
+
+    async def get_bot_data(self):
+        data = dict(self.load("bot_data"))
+        rows = self.connect().execute("SELECT kind, value FROM state WHERE kind LIKE 'bot_data.%'").fetchall()
+        for kind, value in rows:
+            name, key, item = pickle.loads(value)
+            if kind.startswith("bot_data.set:"):
+                data.setdefault(name, set()).add(key)
+                self.members.setdefault(kind, set()).add(key)
+            else:
+                data.setdefault(name, {})[key] = item
+                # bot_data живой, изменения на месте не должны попасть в то, с чем сравниваем
+                self.members.setdefault(kind, {})[key] = copy.deepcopy(item)
+        return data
+
+    def store_members(self, data):
+        """Writes the added, changed and removed members of the sets and dicts in bot_data,
+        returns the rest of bot_data for store()"""
+        plain = {}
+        changed = []
+        removed = []
+        members = {}
+        missing = object()
+        for name, value in data.items():
+            if isinstance(value, (set, frozenset)):
+                kind = f"bot_data.set:{name!r}"
+                # Разница множеств считается в C, цикл только по изменившимся
+                stored = self.members.get(kind, set())
+                removed += [(kind, repr(key)) for key in stored - value]
+                members[kind] = value
+                items = dict.fromkeys(value - stored)
+            elif isinstance(value, dict):
+                kind = f"bot_data.dict:{name!r}"
+                # Прошлая копия bot_data от PTB не меняется, поэтому сравниваем значения, а не их pickle
+                stored = self.members.get(kind, {})
+                items = {key: item for key, item in value.items() if stored.get(key, missing) != item}
+                removed += [(kind, repr(key)) for key in stored if key not in value]
+                members[kind] = value
+            else:
+                plain[name] = value
+                continue
+            changed += [(kind, repr(key), pickle.dumps((name, key, item), pickle.HIGHEST_PROTOCOL))
+                        for key, item in items.items()]
+        dropped = [(kind,) for kind in self.members if kind not in members]
+        if changed or removed or dropped:
+            with self.connect() as connection:
+                connection.executemany("INSERT OR REPLACE INTO state (kind, key, value) VALUES (?, ?, ?)", changed)
+                connection.executemany("DELETE FROM state WHERE kind = ? AND key = ?", removed)
+                connection.executemany("DELETE FROM state WHERE kind = ?", dropped)
+        self.members = members
+        return plain
+
+    async def get_chat_data(self):
+        return dict(self.load("chat_data"))
+
+    async def get_user_data(self):
+        return dict(self.load("user_data"))
+
+    async def get_callback_data(self):
+        stored = self.load("callback_data")
+        return stored[0][1] if stored else None
+
+    async def get_conversations(self, name):
+        return dict(self.load(f"conversation:{name}"))
+
+    async def update_bot_data(self, data):
+        self.store("bot_data", self.store_members(data), replace=True)
+
+    async def update_chat_data(self, chat_id, data):
+        self.store("chat_data", {chat_id: data})
+
+    async def update_user_data(self, user_id, data):
+        self.store("user_data", {user_id: data})
+
+    async def update_callback_data(self, data):
+        self.store("callback_data", {"": data})
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self.drop(f"conversation:{name}", key)
+        else:
+            self.store(f"conversation:{name}", {key: new_state})
+
+    async def drop_chat_data(self, chat_id):
+        self.drop("chat_data", chat_id)
+
+    async def drop_user_data(self, user_id):
+        self.drop("user_data", user_id)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def flush(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Appends the raw update to the record file, for replaying with webhook_replay.py."""
+    with open(bot_config.record_updates, 'a', encoding='utf-8') as recf:
+        recf.write(update.to_json() + '\n')
+
+
+class Route:
+    """A group message command: regex searched in the text, optionally only in replies or in one chat"""
+    def __init__(self, pattern, handler, reply=False, chat_id=None):
+        self.pattern = pattern
+        self.handler = handler
+        self.reply = reply
+        self.chat_id = chat_id
+
+
+class GroupRouter:
+    """Routes new group messages to the first route whose conditions and regex match, in route order;
+    everything else goes to moderation. The chat is resolved once and handed to the handler"""
+    def __init__(self, routes):
+        self.routes = [(route, re.compile(route.pattern)) for route in routes]
+
+    def select(self, update):
+        """The handler for the message"""
+        message = update.effective_message
+        if update.message is not None and message.text:
+            # Regex ищем по очереди: отдельный search с поиском литерала быстрее одного общего шаблона
+            replied = message.reply_to_message is not None
+            for route, pattern in self.routes:
+                if (replied or route.reply is False) and (route.chat_id is None or message.chat.id == route.chat_id) \
+                        and pattern.search(message.text) is not None:
+                    return route.handler
+        if message.text:
+            return moderation_msg
+        return moderation_caption
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat_id = update.effective_chat.id
+        chat = chat_key(chat_id) if chat_id in chats or chat_id in support_chats else None
+        await self.select(update)(update, context, chat)
+
+
+def build_group_router():
+    """Group commands in the order they are tried"""
+    return GroupRouter([
+        Route(f"^Бусти https://boosty.to/", new_post, chat_id=-1001540432154),  # New post announce
+        Route(f"^{bot_config.admin_command_start}", adm_chat_commands),  # Admin commands
+        Route(bot_config.warn_keyword, warn_user, reply=True),  # Warning users
+        Route(f"^[M|m]ute", mute_user, reply=True),  # Mute users
+        Route(f"Ban", ban_user, reply=True),  # Ban users
+        Route(bot_config.random_fun_keyword, random_fun),  # Random fun messages
+        Route(bot_config.random_game_keyword, random_game),  # Random numbers game
+        Route(bot_config.helper_keyword, helper),  # Chat content request
+    ])
+
+
+def add_handlers(application: Application) -> None:
+    """Registers the bot's update handlers, shared by main() and bench.py"""
     # Keep track of which chats the bot is in
     application.add_handler(ChatMemberHandler(track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
     # application.add_handler(CommandHandler("show_chats", show_chats))
@@ -856,55 +2321,54 @@ def main() -> None:
     # VIP chat special
     application.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.UpdateType.CHANNEL_POST, forward_vip))
 
-    # New post announce
-    application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.Chat(-1001540432154) & filters.Regex(f"^Бусти https://boosty.to/"),
-        new_post))
-
-    # Admin commands
-    application.add_handler(MessageHandler(
-            filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.Regex(f"^{bot_config.admin_command_start}"),
-            adm_chat_commands))
-
-    # Warning users
-    application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.REPLY & filters.Regex(bot_config.warn_keyword),
-        warn_user))
+    # Commands and moderation of group messages
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS & (filters.TEXT | filters.CAPTION),
+                                           build_group_router()))
 
-    # Mute users
+    # Delete chat join messages
     application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.REPLY & filters.Regex(f"^[M|m]ute"), mute_user))
+        filters.ChatType.GROUPS & filters.StatusUpdate.NEW_CHAT_MEMBERS, delete_join))
 
-    # Ban users
-    application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.REPLY & filters.Regex(f"Ban"), ban_user))
 
-    # Random fun messages
-    application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.Regex(bot_config.random_fun_keyword),
-        random_fun))
+def build_application(builder=None) -> Application:
+    """The bot's Application with its hooks, persistence and handlers, shared by main() and bench.py"""
+    if builder is None:
+        builder = Application.builder().token(bot_config.telegram_token)
+    application = builder.post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown) \
+        .persistence(SqlitePersistence(bot_config.state_file)) \
+        .concurrent_updates(ChatOrderedUpdateProcessor(bot_config.concurrent_updates)).build()
 
-    # Random numbers game
-    application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.Regex(bot_config.random_game_keyword),
-        random_game))
+    application.add_handler(TypeHandler(Update, first_update), group=-1)
+    if bot_config.record_updates:
+        application.add_handler(TypeHandler(Update, record_update), group=-2)
+    add_handlers(application)
+    return application
 
-    # Chat content request
-    application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & filters.Regex(bot_config.helper_keyword), helper))
 
-    # Delete chat join messages
-    application.add_handler(MessageHandler(
-        filters.ChatType.GROUPS & filters.StatusUpdate.NEW_CHAT_MEMBERS, delete_join))
-
-    # Moderating chats
-    application.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.TEXT, moderation_msg))
-    application.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.CAPTION, moderation_caption))
+def main() -> None:
+    """Start the bot."""
+    # Create the Application and pass it your bot's token.
+    application = build_application()
 
     # Run the bot until the user presses Ctrl-C
     # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
     # To reset this, simply pass `allowed_updates=[]`
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if bot_config.webhook:
+        # Telegram шлет апдейты на наш HTTP-сервер, чужие запросы без секрета получают 403
+        webhook = bot_config.webhook
+        if not webhook.get('secret_token'):
+            logger.warning("Webhook mode without secret_token: any request to the url is accepted")
+        application.run_webhook(listen=webhook.get('listen', '0.0.0.0'),
+                                port=webhook.get('port', 8443),
+                                url_path=webhook.get('path', ''),
+                                webhook_url=webhook.get('url'),
+                                secret_token=webhook.get('secret_token'),
+                                cert=webhook.get('cert'),
+                                key=webhook.get('key'),
+                                max_connections=webhook.get('max_connections', 40),
+                                allowed_updates=Update.ALL_TYPES)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
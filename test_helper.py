@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+CHAT = -1
+
+
+@pytest.fixture
+def chat_my(monkeypatch):
+    chat_my = main.ChatMy(CHAT, [], [], [], ["пакость"], [], [], [], ["сейчас"],
+                          [{"command": "бот правила", "content": "Правила чата", "delay": "No"}], {},
+                          {"ping_words": {"state": False}}, -2)
+    monkeypatch.setitem(main.chats.loaded, CHAT, chat_my)
+    monkeypatch.setitem(main.chats.chat_ids, CHAT, None)
+    return chat_my
+
+
+class FakePipeline:
+    """Moderation that handles the messages containing a trigger word, as the real trigger stage would"""
+    def __init__(self):
+        self.texts = []
+
+    async def run(self, update, context, text, chat=None):
+        self.texts.append(text)
+        return main.find_trigger_word(main.chats[chat].verdicts.tokens(text), main.chats[chat]) is not False
+
+
+def run_helper(monkeypatch, text):
+    pipeline = FakePipeline()
+    replies = []
+    monkeypatch.setattr(main, "moderation_pipeline", pipeline)
+    monkeypatch.setattr(main, "outbound_reply", lambda message, reply, **kwargs: replies.append(reply))
+    update = SimpleNamespace(message=SimpleNamespace(text=text, message_id=1), effective_chat=SimpleNamespace(id=CHAT))
+    asyncio.run(main.helper(update, None, CHAT))
+    return pipeline.texts, replies
+
+
+def test_exact_command_is_answered_without_moderation(chat_my, monkeypatch):
+    assert main.helper_find(chat_my, "Бот правила") == (chat_my.helper[0], True)
+    assert run_helper(monkeypatch, "Бот правила") == ([], ["Правила чата"])
+
+
+def test_words_after_command_are_moderated(chat_my, monkeypatch):
+    text = "бот правила пакость"
+    assert main.helper_find(chat_my, text) == (chat_my.helper[0], False)
+    assert run_helper(monkeypatch, text) == ([text], [])
+
+
+def test_clean_words_after_command_get_the_answer(chat_my, monkeypatch):
+    text = "бот правила пожалуйста"
+    assert run_helper(monkeypatch, text) == ([text], ["Правила чата"])
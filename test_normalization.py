@@ -0,0 +1,52 @@
+import random
+import re
+
+import main
+
+
+def reference_replace_letters(word):
+    """replace_letters before the translate table: one re.sub per dict_re entry"""
+    word = word.lower()
+    for key, value in main.dict_re.items():
+        word = re.sub(value, key, word)
+    return word
+
+
+def reference_normalize_word(w):
+    """The old delete_word/filter_word normalization: drop repeats, lower, fold letters"""
+    w = ''.join([w[i] for i in range(len(w) - 1) if w[i + 1] != w[i]] + [w[-1]]).lower()
+    return reference_replace_letters(w)
+
+
+def alphabet():
+    chars = {char for value in main.dict_re.values() for char in value}
+    chars |= set(main.dict_re)
+    chars |= {char.upper() for char in chars}
+    chars |= {'\u0301', ' ', '-'}
+    return sorted(chars)
+
+
+def random_words(seed, number=5000):
+    rnd = random.Random(seed)
+    chars = alphabet()
+    for _ in range(number):
+        word = ''.join(rnd.choice(chars) for _ in range(rnd.randint(1, 12)))
+        if rnd.random() < 0.3:
+            position = rnd.randrange(len(word))
+            word = word[:position] + word[position] * rnd.randint(2, 5) + word[position:]
+        yield word
+
+
+def test_replace_letters_matches_re_sub_chain():
+    for word in random_words(1):
+        assert main.replace_letters(word) == reference_replace_letters(word), word
+
+
+def test_normalize_word_matches_old_normalization():
+    for word in random_words(2):
+        assert main.normalize_word(word) == reference_normalize_word(word), word
+
+
+def test_normalize_word_examples():
+    assert main.normalize_word("Приииииивет") == reference_normalize_word("Приииииивет")
+    assert main.normalize_word("ПРИВЕ\u0301Т") == reference_normalize_word("ПРИВЕ\u0301Т")
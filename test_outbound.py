@@ -0,0 +1,190 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+FAST = dict(global_rate=10 ** 6, group_rate=10 ** 6, private_rate=10 ** 6, chat_burst=10 ** 6)
+
+
+class FakeBot:
+    """Records the calls it gets with their times; a call raises the queued errors for its text first"""
+    def __init__(self):
+        self.sent = []
+        self.errors = {}
+
+    def send_message(self, chat_id, text):
+        async def call():
+            errors = self.errors.get(text)
+            if errors:
+                raise errors.pop(0)
+            self.sent.append((chat_id, text, time.monotonic()))
+            return text
+        return call
+
+    def texts(self):
+        return [text for _, text, _ in self.sent]
+
+
+def run(scenario):
+    return asyncio.run(asyncio.wait_for(scenario(), 10))
+
+
+def test_moderation_goes_first():
+    async def scenario():
+        bot = FakeBot()
+        queue = main.OutboundQueue(concurrency=1, **FAST)
+        queue.submit(-1, bot.send_message(-1, "low"), priority=main.PRIORITY_LOW)
+        queue.submit(-2, bot.send_message(-2, "normal"))
+        queue.submit(-3, bot.send_message(-3, "moderation"), priority=main.PRIORITY_MODERATION)
+        await queue.join()
+        return bot.texts()
+
+    assert run(scenario) == ["moderation", "normal", "low"]
+
+
+def test_one_chat_keeps_submission_order():
+    async def scenario():
+        bot = FakeBot()
+        queue = main.OutboundQueue(**FAST)
+        for number in range(5):
+            queue.submit(-1, bot.send_message(-1, str(number)))
+        await queue.join()
+        return bot.texts()
+
+    assert run(scenario) == ["0", "1", "2", "3", "4"]
+
+
+def test_chat_budget_spaces_messages():
+    async def scenario():
+        bot = FakeBot()
+        queue = main.OutboundQueue(global_rate=10 ** 6, group_rate=20, chat_burst=1)
+        futures = [queue.submit(-1, bot.send_message(-1, str(number))) for number in range(4)]
+        futures.append(queue.submit(-2, bot.send_message(-2, "other")))
+        await asyncio.gather(*futures)
+        return bot.sent
+
+    sent = run(scenario)
+    times = [at for chat_id, _, at in sent if chat_id == -1]
+    assert all(later - earlier >= 0.04 for earlier, later in zip(times, times[1:]))
+    # Бюджет одного чата не задерживает другой
+    other = [at for chat_id, _, at in sent if chat_id == -2][0]
+    assert other < times[1]
+
+
+def test_string_chat_id_uses_its_chat_budget():
+    async def scenario():
+        bot = FakeBot()
+        queue = main.OutboundQueue(**FAST)
+        result = await queue.submit("-100", bot.send_message(-100, "text"))
+        return result, set(queue.chat_buckets)
+
+    assert run(scenario) == ("text", {-100})
+
+
+def test_retry_after_pauses_and_repeats():
+    async def scenario():
+        bot = FakeBot()
+        bot.errors["text"] = [RetryAfter(datetime.timedelta(seconds=0.1))]
+        queue = main.OutboundQueue(**FAST)
+        started = time.monotonic()
+        result = await queue.submit(-1, bot.send_message(-1, "text"))
+        return result, time.monotonic() - started, queue.stats()
+
+    result, elapsed, stats = run(scenario)
+    assert result == "text"
+    assert elapsed >= 0.1
+    assert stats['flood_waits'] == 1 and stats['sent'] == 1 and stats['errors'] == 0
+
+
+def test_retry_after_gives_up_after_max_attempts():
+    async def scenario():
+        bot = FakeBot()
+        bot.errors["text"] = [RetryAfter(datetime.timedelta(seconds=0.01)) for _ in range(3)]
+        queue = main.OutboundQueue(max_attempts=2, **FAST)
+        with pytest.raises(RetryAfter):
+            await queue.submit(-1, bot.send_message(-1, "text"))
+        await queue.join()
+        return queue.stats()
+
+    assert run(scenario)['flood_waits'] == 2
+
+
+def test_after_waits_without_holding_a_slot():
+    async def scenario():
+        bot = FakeBot()
+        # У чата -2 нет бюджета: пересылка туда не уйдет, пока тест идет
+        queue = main.OutboundQueue(global_rate=10 ** 6, group_rate=10 ** -6, chat_burst=0, concurrency=1)
+        forwarded = queue.submit(-2, bot.send_message(-2, "forward"))
+        delete = queue.submit(-1, bot.send_message(-1, "delete"), limited=False, after=forwarded)
+        other = queue.submit(-3, bot.send_message(-3, "other"), limited=False)
+        assert await other == "other"
+        assert not delete.done()
+
+        gate = asyncio.get_running_loop().create_future()
+        later = queue.submit(-3, bot.send_message(-3, "later"), limited=False, after=gate)
+        await asyncio.sleep(0.01)
+        assert not later.done()
+        gate.set_result(None)
+        assert await later == "later"
+        forwarded.cancel()
+        with pytest.raises(RuntimeError):
+            await delete
+        await queue.join()
+        return bot.texts()
+
+    assert run(scenario) == ["other", "later"]
+
+
+def test_failed_action_does_not_stop_the_queue():
+    async def scenario():
+        bot = FakeBot()
+        queue = main.OutboundQueue(**FAST)
+        failed = asyncio.get_running_loop().create_future()
+        failed.set_exception(ValueError("forward failed"))
+        dependent = queue.submit(-1, bot.send_message(-1, "delete"), after=failed)
+        bot.errors["broken"] = [ValueError("bad request")]
+        broken = queue.submit(-1, bot.send_message(-1, "broken"))
+        result = await queue.submit(-1, bot.send_message(-1, "text"))
+        return result, dependent, broken, bot.texts()
+
+    result, dependent, broken, texts = run(scenario)
+    assert result == "text" and texts == ["text"]
+    assert isinstance(dependent.exception(), RuntimeError)
+    assert isinstance(broken.exception(), ValueError)
+
+
+def test_long_retry_after_fails_the_action():
+    async def scenario():
+        bot = FakeBot()
+        bot.errors["text"] = [RetryAfter(datetime.timedelta(seconds=3600))]
+        queue = main.OutboundQueue(max_retry_after=60, **FAST)
+        with pytest.raises(RetryAfter):
+            await queue.submit(-1, bot.send_message(-1, "text"))
+        await queue.join()
+        return queue.stats()
+
+    stats = run(scenario)
+    assert stats['flood_waits'] == 1 and stats['errors'] == 1
+
+
+def test_stop_drops_low_priority_and_bounds_the_wait():
+    async def scenario():
+        bot = FakeBot()
+        # Бюджет чата на один вызов: остальное ждало бы почти вечно
+        queue = main.OutboundQueue(global_rate=10 ** 6, group_rate=10 ** -6, chat_burst=1)
+        greeting = queue.submit(-2, bot.send_message(-2, "greeting"), priority=main.PRIORITY_LOW)
+        first = queue.submit(-1, bot.send_message(-1, "first"))
+        second = queue.submit(-1, bot.send_message(-1, "second"))
+        started = time.monotonic()
+        await queue.stop(0.2)
+        await queue.join()
+        return time.monotonic() - started, greeting, first, second, bot.texts()
+
+    elapsed, greeting, first, second, texts = run(scenario)
+    assert elapsed < 1
+    assert texts == ["first"]
+    assert greeting.cancelled() and second.cancelled() and first.result() == "first"
@@ -0,0 +1,71 @@
+import asyncio
+import copy
+import pickle
+import sqlite3
+
+import main
+
+
+def flush(persistence, data):
+    """update_bot_data as PTB calls it: with a deep copy; returns the rows written"""
+    connection = persistence.connect()
+    before = connection.total_changes
+    asyncio.run(persistence.update_bot_data(copy.deepcopy(data)))
+    return connection.total_changes - before
+
+
+def reload(path):
+    persistence = main.SqlitePersistence(path)
+    return persistence, asyncio.run(persistence.get_bot_data())
+
+
+def test_bot_data_round_trip(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    data = {"user_ids": {1, 2, 3}, "group_ids": set(), "random_game_ignore": {-1: [5, 7]}, "version": 2}
+    persistence = main.SqlitePersistence(path)
+    flush(persistence, data)
+    asyncio.run(persistence.flush())
+    assert reload(path)[1] == {"user_ids": {1, 2, 3}, "random_game_ignore": {-1: [5, 7]}, "version": 2}
+
+
+def test_only_changed_members_are_written(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    data = {"user_ids": set(range(1000)), "random_game_ignore": {-1: [5], -2: [6]}}
+    persistence = main.SqlitePersistence(path)
+    assert flush(persistence, data) == 1002
+    assert flush(persistence, data) == 0
+    data["user_ids"].add(5000)
+    data["user_ids"].discard(0)
+    data["random_game_ignore"][-2].append(9)
+    assert flush(persistence, data) == 3
+
+    persistence, loaded = reload(path)
+    assert loaded == data
+    # Загруженное состояние не переписывается заново, изменения на месте записываются
+    assert flush(persistence, loaded) == 0
+    loaded["random_game_ignore"][-1].append(8)
+    assert flush(persistence, loaded) == 1
+
+
+def test_removed_names_are_deleted(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    persistence = main.SqlitePersistence(path)
+    flush(persistence, {"user_ids": {1, 2}, "random_game_ignore": {-1: [5]}})
+    flush(persistence, {"random_game_ignore": {}})
+    assert reload(path)[1] == {}
+
+
+def test_whole_set_row_is_migrated(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    # Прежний формат: весь набор в одной строке
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE state (kind TEXT, key TEXT, value BLOB, PRIMARY KEY (kind, key))")
+        connection.execute("INSERT INTO state VALUES (?, ?, ?)",
+                           ("bot_data", repr("user_ids"), pickle.dumps(("user_ids", {1, 2}))))
+    persistence, loaded = reload(path)
+    assert loaded == {"user_ids": {1, 2}}
+    flush(persistence, loaded)
+    with sqlite3.connect(path) as connection:
+        kinds = sorted(kind for kind, in connection.execute("SELECT kind FROM state"))
+    assert kinds == ["bot_data.set:'user_ids'", "bot_data.set:'user_ids'"]
+    assert reload(path)[1] == {"user_ids": {1, 2}}
@@ -0,0 +1,60 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+USER = 500
+
+
+class FakeOutbound:
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, chat_id, call, **kwargs):
+        self.calls.append(call)
+
+
+class FakeBot:
+    def __init__(self):
+        self.forwarded = []
+
+    def send_message(self, chat_id, text):
+        return None
+
+    def forward_messages(self, chat_id, from_chat_id, message_ids):
+        self.forwarded.append(list(message_ids))
+
+
+@pytest.fixture
+def context(monkeypatch):
+    outbound = FakeOutbound()
+    monkeypatch.setattr(main, "outbound", outbound)
+    monkeypatch.setattr(main, "private_forwards", main.PrivateForwards())
+    jobs = []
+    context = SimpleNamespace(bot=FakeBot(), outbound=outbound, jobs=jobs,
+                              job_queue=SimpleNamespace(run_once=lambda *args, **kwargs: jobs.append(kwargs)))
+    return context
+
+
+def private_update(message_id, edited=False):
+    message = SimpleNamespace(message_id=message_id, text="привет", caption=None, forward=lambda chat_id: None)
+    return SimpleNamespace(effective_user=SimpleNamespace(id=USER), effective_message=message,
+                           message=None if edited else message)
+
+
+def test_edits_do_not_enter_the_batch(context):
+    for message_id, edited in [(1, False), (2, False), (1, True), (3, False), (2, True)]:
+        asyncio.run(main.forward(private_update(message_id, edited), context))
+    assert len(context.jobs) == 1
+    assert main.private_forwards.pending[USER] == [2, 3]
+
+
+def test_flush_sends_increasing_unique_ids(context):
+    main.private_forwards.pending[USER] = [5, 3, 5, 4]
+    context.job = SimpleNamespace(data=(USER, "user"))
+    asyncio.run(main.private_forwards_flush(context))
+    for call in context.outbound.calls:
+        call()
+    assert context.bot.forwarded == [[3, 4, 5]]
@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+CHAT = -1
+SUPPORT_CHAT = -2
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    chat_my = main.ChatMy(CHAT, [], [], [], [], [], [], [], [], [], {}, {}, SUPPORT_CHAT)
+    monkeypatch.setitem(main.chats.loaded, CHAT, chat_my)
+    monkeypatch.setitem(main.chats.chat_ids, CHAT, None)
+
+    async def detect_chat_adm(message):
+        return True
+
+    replies = []
+    monkeypatch.setattr(main, "detect_chat_adm", detect_chat_adm)
+    monkeypatch.setattr(main, "outbound_reply", lambda message, reply, **kwargs: replies.append(reply))
+    return replies
+
+
+def play(context, chat_id, text):
+    update = SimpleNamespace(message=SimpleNamespace(text=text), effective_chat=SimpleNamespace(id=chat_id))
+    asyncio.run(main.random_game(update, context, CHAT))
+
+
+@pytest.mark.parametrize("text", [
+    "игра 1 1 10 50",  # исключение вне диапазона
+    "игра 1 10 1 5",  # перевернутый диапазон
+    "игра 1 1 10000 " + " ".join(str(number) for number in range(1, 1100)),  # слишком много исключений
+    "игра 5 1 10 1 2 3 4 5 6 7",  # исключения не оставляют чисел
+    "игра 1 1 10 " + "9" * 40,  # огромное число
+])
+def test_rejected_exclusions_are_not_saved(replies, text):
+    context = SimpleNamespace(bot_data={"random_game_ignore": {CHAT: [3]}})
+    play(context, SUPPORT_CHAT, text)
+    assert context.bot_data["random_game_ignore"] == {CHAT: [3]}
+    assert not replies[-1].startswith("Случайные числа")
+    play(context, CHAT, "игра 2 1 3")
+    assert replies[-1] in ("Случайные числа: [1, 2].", "Случайные числа: [2, 1].")
+
+
+def test_accepted_exclusions_apply_to_the_chat(replies):
+    context = SimpleNamespace(bot_data={})
+    play(context, SUPPORT_CHAT, "игра 1 1 3 1 2")
+    assert context.bot_data["random_game_ignore"] == {CHAT: [1, 2]}
+    assert replies[-1] == "Случайные числа: [3]."
+    play(context, CHAT, "игра 1 1 3")
+    assert replies[-1] == "Случайные числа: [3]."
@@ -0,0 +1,70 @@
+import threading
+
+import main
+
+
+class FakeWorksheet:
+    """Records append_rows batches; the first `failures` calls raise"""
+    def __init__(self, failures=0, error=RuntimeError):
+        self.batches = []
+        self.calls = 0
+        self.failures = failures
+        self.error = error
+        self.appended = threading.Event()
+
+    def append_rows(self, rows):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error("sheet is down")
+        self.batches.append(list(rows))
+        self.appended.set()
+
+
+def test_rows_are_written_in_batches():
+    worksheet = FakeWorksheet()
+    writer = main.SheetLogWriter(worksheet, batch_size=3, flush_interval=60)
+    for number in range(7):
+        writer.put([number])
+    writer.close()
+    assert worksheet.batches == [[[0], [1], [2]], [[3], [4], [5]], [[6]]]
+
+
+def test_partial_batch_is_flushed_after_interval():
+    worksheet = FakeWorksheet()
+    writer = main.SheetLogWriter(worksheet, batch_size=20, flush_interval=0.05)
+    writer.put(["row"])
+    assert worksheet.appended.wait(5)
+    assert worksheet.batches == [[["row"]]]
+    writer.close()
+
+
+def test_failed_append_is_retried():
+    worksheet = FakeWorksheet(failures=2, error=ValueError)
+    writer = main.SheetLogWriter(worksheet, batch_size=1, retry_delay=0)
+    writer.put(["row"])
+    writer.close()
+    assert worksheet.calls == 3
+    assert worksheet.batches == [[["row"]]]
+    assert writer.thread is None
+
+
+def test_rows_are_kept_until_worksheet_connects():
+    writer = main.SheetLogWriter(batch_size=2, flush_interval=0.01)
+    writer.put(["a"])
+    writer.put(["b"])
+    writer.put(["c"])
+    worksheet = FakeWorksheet()
+    writer.worksheet = worksheet
+    writer.close()
+    assert [row for batch in worksheet.batches for row in batch] == [["a"], ["b"], ["c"]]
+
+
+def test_dead_thread_is_restarted():
+    worksheet = FakeWorksheet()
+    writer = main.SheetLogWriter(worksheet, batch_size=1)
+    writer.thread = threading.Thread(target=lambda: None)
+    writer.thread.start()
+    writer.thread.join()
+    writer.put(["row"])
+    writer.close()
+    assert worksheet.batches == [[["row"]]]
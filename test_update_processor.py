@@ -0,0 +1,58 @@
+import asyncio
+
+from telegram import Update
+
+import main
+
+
+def make_update(update_id, chat_id):
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 1700000000, "text": "x",
+        "chat": {"id": chat_id, "type": "supergroup", "title": "test"}}}, None)
+
+
+def test_one_chat_backlog_does_not_stop_other_chats():
+    async def scenario():
+        processor = main.ChatOrderedUpdateProcessor(2)
+        gate = asyncio.Event()
+        done = []
+
+        async def handle(name, wait=False):
+            if wait:
+                await gate.wait()
+            done.append(name)
+
+        # Первый апдейт чата -1 завис, за ним очередь больше любого разумного предела
+        tasks = [asyncio.create_task(processor.process_update(make_update(1, -1), handle("a0", wait=True)))]
+        for number in range(1, 200):
+            tasks.append(asyncio.create_task(processor.process_update(make_update(number + 1, -1),
+                                                                      handle(f"a{number}"))))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(make_update(1000, -2), handle("b")), 5)
+        assert done == ["b"]
+        gate.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        return done
+
+    done = asyncio.run(scenario())
+    assert done[1:] == [f"a{number}" for number in range(200)]
+
+
+def test_running_updates_are_limited():
+    async def scenario():
+        processor = main.ChatOrderedUpdateProcessor(2)
+        running = 0
+        peak = 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*[processor.process_update(make_update(number, -number), handle())
+                               for number in range(1, 11)])
+        return peak
+
+    assert asyncio.run(scenario()) == 2
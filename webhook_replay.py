@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Replays recorded updates against the bot running in webhook mode.
+Updates are recorded by the bot itself when "record_updates" in config.json names a file,
+one JSON update per line.
+Usage:
+python webhook_replay.py updates.jsonl http://127.0.0.1:8443/telegram --secret <secret_token> --concurrency 20
+Prints the number of updates sent, updates/sec and p50/p99 response latency.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+async def replay(updates, url, secret, concurrency):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failed = 0
+
+    async def post(client, update):
+        nonlocal failed
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(url, json=update, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                failed += 1
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(post(client, update) for update in updates))
+        elapsed = time.perf_counter() - started
+    return latencies, failed, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="POST recorded Telegram updates to the bot's webhook")
+    parser.add_argument("updates", help="file with one JSON update per line")
+    parser.add_argument("url", help="webhook url, e.g. http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", help="secret_token from the webhook config")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight")
+    parser.add_argument("--repeat", type=int, default=1, help="send the recording this many times")
+    args = parser.parse_args()
+
+    with open(args.updates, 'r', encoding='utf-8') as updf:
+        recorded = [json.loads(line) for line in updf if line.strip()]
+    updates = []
+    for round_number in range(args.repeat):
+        for update in recorded:
+            # Свои update_id, чтобы повторы выглядели для бота новыми апдейтами
+            updates.append(dict(update, update_id=len(updates) + 1))
+
+    latencies, failed, elapsed = asyncio.run(replay(updates, args.url, args.secret, args.concurrency))
+    print(f"updates: {len(updates)}, failed: {failed}, {len(updates) / elapsed:.1f} updates/sec")
+    print(f"latency p50: {percentile(latencies, 0.5) * 1000:.1f} ms, p99: {percentile(latencies, 0.99) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()